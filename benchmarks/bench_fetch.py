@@ -0,0 +1,142 @@
+"""
+Throughput benchmark of the pipeline fetchers against the local mock server.
+
+Runs `load_listing.fetch_data` and/or the CBE school fetchers of `schools scraper/scraper_db_async.py`
+at several concurrency settings and reports requests/sec, p50/p99 latency and end-to-end wall time.
+
+Usage:
+    python benchmarks/bench_fetch.py --target listings --concurrency 5 10 20 50 --latency lognormal:0.2,0.5 --error-rate 0.02
+    python benchmarks/bench_fetch.py --target listings --fetch-mode community tile --concurrency 10
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from time import perf_counter
+import httpx
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from mock_server import MockServer, MAP_PATH, DIRECTORY_PATH, PROFILE_PATH, OVERLAYS_PATH, add_config_arguments, config_from_args
+
+
+def summarize(target, mode, concurrency, latencies, wall, server, duplicate_ratio=np.nan):
+    stats = server.stats()
+    latencies = np.asarray(latencies) if latencies else np.array([np.nan])
+    return {
+        'target': target,
+        'mode': mode,
+        'concurrency': concurrency,
+        'requests': stats['requests'],
+        'requests_per_sec': stats['requests'] / wall if wall else np.nan,
+        'p50_latency_ms': np.nanpercentile(latencies, 50) * 1000,
+        'p99_latency_ms': np.nanpercentile(latencies, 99) * 1000,
+        'wall_time_s': wall,
+        'duplicate_ratio': duplicate_ratio,
+        'statuses': stats['statuses']
+    }
+
+
+def bench_listings(server, concurrency, mode='community'):
+    """
+    End-to-end run of load_listing.fetch_data, including ExtractSchema validation.
+    """
+    import load_listing
+
+    load_listing.FETCH_MODE = mode
+    load_listing.COMM_LIST_PATH = os.path.join(REPO_DIR, 'get_community_list', 'community_list.csv')
+    load_listing.TILE_PLAN_PATH = 'cache/tile_plan.json' # relative to the temporary working directory
+    load_listing.COMMUNITY_BOUNDARIES_PATH = os.path.join(REPO_DIR, 'community_boundaries', 'Community_District_Boundaries_20231230.csv')
+    load_listing.MAP_URL = server.url + MAP_PATH
+    load_listing.MAX_CONCURRENT_REQUESTS = concurrency
+    load_listing.MAX_CONNECTIONS = concurrency
+    load_listing.MAX_KEEPALIVE_CONNECTIONS = concurrency
+    load_listing.REFETCH_DELAY = 1.0
+    load_listing.USE_FINGERPRINT_CACHE = False # measure the full download every time
+
+    report = load_listing.FetchReport()
+    start = perf_counter()
+    load_listing.validate_extract(asyncio.run(load_listing.fetch_data(report)))
+    wall = perf_counter() - start
+    latencies = [s.latency for s in report.stats.values() if s.status == 'ok']
+    return latencies, wall, report.duplicate_ratio
+
+
+def bench_schools(server, concurrency, mode=None):
+    """
+    School directory, profile pages and overlays as fetched by scraper_db_async.main, without the database writes.
+    """
+    sys.path.insert(0, os.path.join(REPO_DIR, 'schools scraper'))
+    import scraper_db_async as scraper
+
+    scraper.SCHOOL_DIRECTORY_URL = server.url + DIRECTORY_PATH
+    scraper.PROFILE_URL = server.url + PROFILE_PATH
+    scraper.OVERLAYS_URL = server.url + OVERLAYS_PATH
+    latencies = []
+
+    async def on_request(request):
+        request.extensions['bench_start'] = perf_counter()
+
+    async def on_response(response):
+        latencies.append(perf_counter() - response.request.extensions['bench_start'])
+
+    async def run():
+        scraper.semaphore = asyncio.Semaphore(concurrency)
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(timeout=60.0, limits=limits, event_hooks={'request': [on_request], 'response': [on_response]}) as client:
+            headers = {"User-Agent": "bench"}
+            school_ids = await scraper.get_school_ids(client, headers)
+            await scraper.detail_page_loop(client, headers, school_ids)
+
+    start = perf_counter()
+    asyncio.run(run())
+    return latencies, perf_counter() - start, np.nan
+
+
+TARGETS = {'listings': bench_listings, 'schools': bench_schools}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=[*TARGETS, 'all'], default='listings')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[5, 10, 20, 50])
+    parser.add_argument('--fetch-mode', nargs='+', choices=['community', 'tile'], default=['community'],
+                        help='extraction modes of load_listing to compare')
+    parser.add_argument('--output', default='', help='optional CSV file for the results')
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    targets = list(TARGETS) if args.target == 'all' else [args.target]
+    results = []
+    # The fetchers write debug files relative to the working directory, keep them out of the repo
+    with tempfile.TemporaryDirectory() as workdir, MockServer(config_from_args(args)) as server:
+        os.chdir(workdir)
+        os.makedirs('log', exist_ok=True)
+        for target in targets:
+            modes = args.fetch_mode if target == 'listings' else ['']
+            for mode in modes:
+                for concurrency in args.concurrency:
+                    server.reset_stats()
+                    latencies, wall, duplicate_ratio = TARGETS[target](server, concurrency, mode)
+                    results.append(summarize(target, mode, concurrency, latencies, wall, server, duplicate_ratio))
+        os.chdir(REPO_DIR)
+
+    df = pd.DataFrame(results)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(df.round(2).to_string(index=False))
+    if args.output:
+        df.to_csv(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main()
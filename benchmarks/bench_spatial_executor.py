@@ -0,0 +1,70 @@
+"""
+Scaling benchmark of `spatial_executor.run_joins` by number of worker processes.
+
+Runs the three joins of the spatial joins stage (communities, attendance areas and walk zones) at the
+same time on random points, with the zones of `bench_zone_index.py`, and reports points/s, (point, zone)
+pairs/s and the speedup over mapping in the calling process. The results of every worker count are checked
+to be the same as in the calling process.
+
+Usage:
+    python benchmarks/bench_spatial_executor.py --points 1000000 --workers 1 2 4 8
+"""
+import argparse
+import os
+import sys
+from timeit import default_timer
+import pandas as pd
+from loguru import logger
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from bench_zone_index import community_zones, school_zones, make_points
+from spatial_executor import CHUNK_SIZE, SpatialJob, default_workers, run_joins
+from zone_index import ZoneIndex
+
+
+def sorted_pairs(results):
+    return {name: df.sort_values(list(df.columns)).reset_index(drop=True) for name, df in results.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=1_000_000, help='points per join')
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, 2, 4, default_workers()}))
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    logger.remove()
+
+    communities = community_zones()
+    bounds = communities.total_bounds
+    df = make_points(bounds, args.points)
+    jobs = [SpatialJob('crime', ZoneIndex.from_geodataframe(communities, 'zone_id', 'communities'), df, 'row_id'),
+            SpatialJob('attendance_area', ZoneIndex.from_geodataframe(school_zones(bounds, seed=1), 'zone_id', 'attendance_area'), df, 'school_id'),
+            SpatialJob('walk_zone', ZoneIndex.from_geodataframe(school_zones(bounds, seed=2), 'zone_id', 'walk_zone'), df, 'school_id')]
+    points = len(jobs) * len(df)
+
+    results = []
+    expected = None
+    for workers in sorted(set([1] + args.workers)):
+        start = default_timer()
+        got = sorted_pairs(run_joins(jobs, workers=workers, chunk_size=args.chunk_size, min_parallel_points=0))
+        seconds = default_timer() - start
+        if expected is None:
+            expected = got
+        elif any(not expected[name].equals(got[name]) for name in expected):
+            raise AssertionError(f'{workers} workers returned other mappings than the calling process')
+        pairs = sum(len(result) for result in got.values())
+        results.append({'workers': workers, 'points': points, 'pairs': pairs, 'seconds': seconds,
+                        'points_per_s': points / seconds, 'pairs_per_s': pairs / seconds})
+
+    report = pd.DataFrame(results)
+    report['speedup'] = report['points_per_s'] / report['points_per_s'].iloc[0]
+    print(f'{default_workers()} cores available')
+    print(report.round(2).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Micro-benchmark of the square footage parsers of load_listing.
+
+Compares the per-row `clean_sq_feet` applied with `Series.apply` against the vectorized
+`clean_sq_feet_column` on synthetic columns shaped like the `sq_feet` column of a fetch: mostly
+numeric strings, some free text and units, and missing values. Both results are checked to be identical.
+
+Usage:
+    python benchmarks/bench_sq_feet.py --rows 10000 100000 1000000
+"""
+import argparse
+import os
+import sys
+from timeit import default_timer
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+os.environ.setdefault('DISABLE_PANDERA_IMPORT_WARNING', 'True')
+from load_listing import clean_sq_feet, clean_sq_feet_column
+
+# Shapes of values seen in the 'sq_feet' field of map.json, '{}' is replaced by a random size
+TEMPLATES = ['{}', '{}', '{}', '{}', '{},000', '{} sq ft', '{} sqft', '{}sf', '{} ft²', 'approx. {} square feet', '{} - {}']
+FREE_TEXT = ['', ' ', 'N/A', 'Not Listed', 'call for details']
+
+
+def make_column(rows, seed=0, missing=0.2, free_text=0.05):
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(200, 3000, rows).astype(str)
+    templates = rng.choice(TEMPLATES, rows)
+    values = np.array([template.replace('{}', size) for template, size in zip(templates, sizes)], dtype=object)
+    kind = rng.random(rows)
+    values[kind < free_text] = rng.choice(FREE_TEXT, int((kind < free_text).sum()))
+    values[kind > 1 - missing] = None
+    return pd.Series(values, dtype=object)
+
+
+def timed(func, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        start = default_timer()
+        result = func()
+        best = min(best, default_timer() - start)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3, help='best of this many runs is reported')
+    args = parser.parse_args(argv)
+
+    results = []
+    for rows in args.rows:
+        column = make_column(rows)
+        per_row, expected = timed(lambda: column.apply(clean_sq_feet).astype('Int64'), args.repeat)
+        vectorized, got = timed(lambda: clean_sq_feet_column(column), args.repeat)
+        if not expected.equals(got):
+            raise AssertionError(f'Parsers disagree on {(expected.fillna(-1) != got.fillna(-1)).sum()} of {rows} rows')
+        results.append({'rows': rows, 'apply_s': per_row, 'vectorized_s': vectorized, 'speedup': per_row / vectorized})
+
+    print(pd.DataFrame(results).round(3).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
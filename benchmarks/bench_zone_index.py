@@ -0,0 +1,108 @@
+"""
+Benchmark of the point-in-zone lookups of the spatial join stages.
+
+Compares the previous path, a GeoDataFrame of points joined with `gpd.sjoin` (which builds a new R-tree
+of the zones on every call), with `zone_index.ZoneIndex`, built once and queried with the listing
+coordinates. Zones are the community boundaries of the repository and synthetic school zones (two
+400-vertex rings per school merged like the dissolve of spatial_join_school, overlapping other schools).
+Points are spread uniformly over the city. Both paths are checked to return the same (point, zone) pairs.
+
+Usage:
+    python benchmarks/bench_zone_index.py --points 1000 100000 1000000
+"""
+import argparse
+import os
+import sys
+from timeit import default_timer
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely import wkt
+from shapely.geometry import Polygon
+from loguru import logger
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from zone_index import ZoneIndex
+
+COMMUNITY_BOUNDARIES_PATH = os.path.join(REPO_DIR, 'community_boundaries', 'Community_District_Boundaries_20231230.csv')
+
+
+def community_zones():
+    boundaries = pd.read_csv(COMMUNITY_BOUNDARIES_PATH, usecols=['MULTIPOLYGON'])
+    return gpd.GeoDataFrame({'zone_id': np.arange(len(boundaries)) + 1},
+                            geometry=[wkt.loads(polygon) for polygon in boundaries['MULTIPOLYGON']], crs='EPSG:4326')
+
+
+def school_zones(bounds, schools=250, vertices=400, seed=0):
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    angles = np.linspace(0, 2 * np.pi, vertices)
+    geometries = []
+    for _ in range(schools):
+        rings = []
+        for _ in range(2):
+            x, y = rng.uniform(minx, maxx), rng.uniform(miny, maxy)
+            radius = rng.uniform(0.005, 0.03)
+            rings.append(Polygon(zip(x + radius * np.cos(angles), y + radius * np.sin(angles))))
+        geometries.append(shapely.union_all(rings))
+    return gpd.GeoDataFrame({'zone_id': np.arange(schools) + 1}, geometry=geometries, crs='EPSG:4326')
+
+
+def make_points(bounds, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    return pd.DataFrame({'id': np.arange(rows) + 1,
+                         'longitude': rng.uniform(minx, maxx, rows),
+                         'latitude': rng.uniform(miny, maxy, rows)})
+
+
+def with_sjoin(df, zones):
+    points = gpd.GeoDataFrame(df[['id']], geometry=gpd.points_from_xy(df['longitude'], df['latitude']), crs='EPSG:4326')
+    return gpd.sjoin(points, zones, how='inner')[['id', 'zone_id']]
+
+
+def pairs(df):
+    return df.sort_values(['id', 'zone_id']).reset_index(drop=True)
+
+
+def timed(func, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        start = default_timer()
+        result = func()
+        best = min(best, default_timer() - start)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, nargs='+', default=[1_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3, help='best of this many runs is reported')
+    args = parser.parse_args(argv)
+    logger.remove()
+
+    communities = community_zones()
+    bounds = communities.total_bounds
+    zone_sets = {'communities': communities, 'schools': school_zones(bounds)}
+
+    results = []
+    for name, zones in zone_sets.items():
+        build, index = timed(lambda: ZoneIndex.from_geodataframe(zones, 'zone_id', name), args.repeat)
+        for rows in args.points:
+            df = make_points(bounds, rows)
+            sjoin, expected = timed(lambda: with_sjoin(df, zones), args.repeat)
+            query, got = timed(lambda: index.join(df), args.repeat)
+            if not pairs(expected).equals(pairs(got)):
+                raise AssertionError(f'{name}: sjoin returned {len(expected)} pairs, ZoneIndex {len(got)}')
+            results.append({'zones': name, 'points': rows, 'pairs': len(got), 'sjoin_s': sjoin,
+                            'index_build_s': build, 'index_query_s': query, 'speedup': sjoin / query})
+
+    print(pd.DataFrame(results).round(4).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+"""
+Local stand-in for the RentFaster and CBE endpoints used by the data pipeline.
+
+Serves recorded or synthetic responses for:
+- POST /api/map.json (RentFaster listings of a community, or of an 'area' bounding box)
+- GET  /schools/school-directory/Pages/default.aspx (CBE school directory)
+- GET  /schools/school-directory/_layouts/15/cbe.service.spm/viewprofile.aspx?id=<school_id>
+- POST /schools/find-a-school/_layouts/15/SchoolProfileManager/SchoolProfileManager.asmx/GetSchoolOverlays
+
+with configurable latency, error rate and 429 throttling, so the fetchers can be benchmarked without the live sites.
+map.json responses carry an ETag and are answered with 304 Not Modified when the request's If-None-Match matches it.
+
+Usage:
+    python benchmarks/mock_server.py --port 8000 --latency lognormal:0.2,0.5 --error-rate 0.02 --rate-limit 50
+"""
+import argparse
+import csv
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import zlib
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+from urllib.parse import parse_qs, urlparse
+from loguru import logger
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MAP_PATH = '/api/map.json'
+DIRECTORY_PATH = '/schools/school-directory/Pages/default.aspx'
+PROFILE_PATH = '/schools/school-directory/_layouts/15/cbe.service.spm/viewprofile.aspx'
+OVERLAYS_PATH = '/schools/find-a-school/_layouts/15/SchoolProfileManager/SchoolProfileManager.asmx/GetSchoolOverlays'
+
+# Rough extent of Calgary, used to place synthetic listings and school zones
+CITY_BOUNDS = (-114.30, 50.85, -113.85, 51.20) # min_long, min_lat, max_long, max_lat
+
+
+class LatencyModel:
+    """
+    Samples the artificial service time of a response.
+
+    Specs: 'none', 'fixed:<seconds>', 'uniform:<low>,<high>' or 'lognormal:<median>,<sigma>'.
+    """
+    def __init__(self, spec='none'):
+        self.spec = spec
+        kind, _, params = spec.partition(':')
+        self.kind = kind
+        self.params = [float(p) for p in params.split(',')] if params else []
+        if kind not in ('none', 'fixed', 'uniform', 'lognormal'):
+            raise ValueError(f'Unknown latency distribution: {spec}')
+
+    def sample(self, rng):
+        if self.kind == 'fixed':
+            return self.params[0]
+        if self.kind == 'uniform':
+            return rng.uniform(self.params[0], self.params[1])
+        if self.kind == 'lognormal':
+            median, sigma = self.params
+            return rng.lognormvariate(math.log(median), sigma)
+        return 0.0
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second with bursts of up to `burst` requests. Used to answer 429 when exceeded.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = perf_counter()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = perf_counter()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+@dataclass
+class MockConfig:
+    latency: str = 'none'
+    error_rate: float = 0.0 # share of requests answered with a 503
+    rate_limit: float = 0.0 # requests per second before answering 429, 0 to disable
+    burst: float = 0.0
+    max_in_flight: int = 0 # concurrent requests before answering 429, 0 to disable
+    retry_after: int = 1 # value of the Retry-After header sent with 429
+    fixtures: str = '' # directory with recorded responses, see load_fixture
+    schools: int = 250 # number of synthetic schools
+    overlap: float = 0.1 # share of a neighbouring community returned with each community, mimicking the live API
+    max_listings: int = 500 # listings returned by one bounding box query, like the map view of the live API
+    etags: bool = True # send ETags with map.json responses and answer 304 to a matching If-None-Match
+    seed: int = 0
+
+
+class SyntheticData:
+    """
+    Deterministic synthetic listings and schools. Every listing belongs to one community;
+    a share of the next community's listings is returned with each community, like the live API does.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.communities = load_communities()
+        self.listings = {}
+        next_id = 100000
+        for community in self.communities:
+            rng = random.Random(zlib.crc32(community.encode()) ^ config.seed)
+            center_long = rng.uniform(CITY_BOUNDS[0], CITY_BOUNDS[2])
+            center_lat = rng.uniform(CITY_BOUNDS[1], CITY_BOUNDS[3])
+            listings = []
+            for _ in range(int(rng.lognormvariate(2.5, 0.8))):
+                next_id += 1
+                listings.append(synthetic_listing(rng, next_id, community, center_lat, center_long))
+            self.listings[community] = listings
+
+    def area_listings(self, area):
+        """
+        Listings inside an 'north,east,south,west' bounding box, capped at max_listings.
+        """
+        north, east, south, west = (float(value) for value in area.split(','))
+        listings = [listing for listings in self.listings.values() for listing in listings
+                    if south <= listing['latitude'] <= north and west <= listing['longitude'] <= east]
+        return listings[:self.config.max_listings], len(listings)
+
+    def community_listings(self, community):
+        listings = list(self.listings.get(community, []))
+        if community in self.listings:
+            neighbour = self.communities[(self.communities.index(community) + 1) % len(self.communities)]
+            extra = self.listings[neighbour]
+            listings += extra[:int(len(extra) * self.config.overlap)]
+        return listings
+
+
+def synthetic_listing(rng, listing_id, community, center_lat, center_long):
+    beds = rng.choice(['studio', '1', '1+den', '2', '2+den', '3', '3+den', '4', None])
+    listing_type = rng.choice(['Apartment', 'Basement', 'House', 'Townhouse', 'Condo', 'Duplex'])
+    return {
+        'ref_id': listing_id,
+        'id': listing_id,
+        'userId': rng.randint(1000, 99999),
+        'phone': '403-555-0100',
+        'phone_2': '',
+        'email': '1',
+        'availability': 'Immediate',
+        'a': '', 'v': '', 'f': '', 's': '',
+        'title': f'{listing_type} in {community}',
+        'intro': 'Bright and spacious unit close to schools, shopping and transit. ' * 3,
+        'city': 'Calgary',
+        'community': community,
+        'latitude': round(center_lat + rng.gauss(0, 0.005), 7),
+        'longitude': round(center_long + rng.gauss(0, 0.008), 7),
+        'marker': 'apartment',
+        'link': f'/ab/calgary/rentals/{listing_type.lower()}/{community.lower().replace(" ", "-")}/{listing_id}',
+        'thumb2': f'https://www.rentfaster.ca/images/{listing_id}.jpg',
+        'preferred_contact': 'phone',
+        'type': listing_type,
+        'price': rng.randrange(900, 4000, 25),
+        'price2': '',
+        'beds': beds,
+        'beds2': '',
+        'sq_feet': rng.choice([None, '', rng.randrange(400, 2500, 50), f'{rng.randrange(400, 2500, 50)} sq ft', 'approx 1,100 sq ft']),
+        'sq_feet2': '',
+        'baths': rng.choice([1, 1.5, 2, 2.5, 3.5, None]),
+        'cats': rng.choice([0.0, 2.0, None]),
+        'dogs': rng.choice([0.0, 2.0, None]),
+        'baths2': '',
+        'utilities_included': ['Heat', 'Water']
+    }
+
+
+def load_communities():
+    with open(os.path.join(REPO_DIR, 'get_community_list', 'community_list.csv'), newline='', encoding='utf-8') as file:
+        return [row[0] for row in csv.reader(file) if row]
+
+
+def load_fixture(fixtures, *parts):
+    """
+    Return the recorded response at fixtures/<parts> if it exists. Layout:
+    map/<community>.json, directory.html, profile/<school_id>.html and overlays/<school_id>.json
+    """
+    if not fixtures:
+        return None
+    path = os.path.join(fixtures, *parts)
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            return file.read()
+    return None
+
+
+def school_polygon(rng, size):
+    center_long = rng.uniform(CITY_BOUNDS[0], CITY_BOUNDS[2])
+    center_lat = rng.uniform(CITY_BOUNDS[1], CITY_BOUNDS[3])
+    points = []
+    for i in range(24):
+        angle = 2 * math.pi * i / 24
+        radius = size * rng.uniform(0.8, 1.2)
+        points.append(f'{center_long + radius * 1.6 * math.cos(angle):.7f} {center_lat + radius * math.sin(angle):.7f} 0')
+    points.append(points[0])
+    return ', '.join(points)
+
+
+def directory_html(config):
+    rows = ''.join(f'<tr class="cbe-sd-schoollist-item" data-id="{school_id}"><td>School {school_id}</td></tr>'
+                   for school_id in range(1, config.schools + 1))
+    return f'<html><body><table>{rows}</table></body></html>'.encode()
+
+
+def profile_html(school_id):
+    rng = random.Random(school_id)
+    spans = {
+        'lblAddress': f'{rng.randint(1, 9999)} {rng.choice(["Elm", "Oak", "Bow"])} Street NW',
+        'lblPhone': '403-555-0199',
+        'lblFax': '403-555-0198',
+        'lblHours': '8:30 AM - 3:30 PM',
+        'lblGrades': 'K-6',
+        'lblWard': str(rng.randint(1, 14)),
+        'lblArea': str(rng.randint(1, 7)),
+        'lblTotalEnrolment': str(rng.randint(150, 900)),
+        'lblDescription': 'A welcoming community school. ' * 5
+    }
+    body = ''.join(f'<span id="ctl00_PlaceHolderMain_{key}">{value}</span>' for key, value in spans.items())
+    enrolment = ''.join(f'<tr><td class="enrol-heading">Grade {grade}</td><td class="enrol-data">{rng.randint(20, 120)}</td></tr>'
+                        for grade in range(1, 7))
+    return (f'<html><body><div id="page-title">School {school_id}</div>{body}'
+            f'<a id="ctl00_PlaceHolderMain_hlEmail">school{school_id}@cbe.ab.ca</a>'
+            f'<table class="table-enrol-num">{enrolment}</table>'
+            f'<div id="programs"><div class="programs-list"><ul><li>Regular</li><li>French Immersion</li></ul></div></div>'
+            f'</body></html>').encode()
+
+
+def overlays_json(school_id):
+    rng = random.Random(school_id)
+    return json.dumps({'d': [
+        {'Type': 2, 'Polygons': [school_polygon(rng, 0.02)]},
+        {'Type': 5, 'Polygons': [school_polygon(rng, 0.008)]}
+    ]}).encode()
+
+
+class MockServer:
+    """
+    Threaded HTTP server running in the background. Use as a context manager:
+
+        with MockServer(MockConfig(latency='fixed:0.1')) as server:
+            load_listing.MAP_URL = server.url + MAP_PATH
+    """
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or MockConfig()
+        self.data = SyntheticData(self.config)
+        self.latency = LatencyModel(self.config.latency)
+        self.bucket = TokenBucket(self.config.rate_limit, self.config.burst or None) if self.config.rate_limit else None
+        self.rng = random.Random(self.config.seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.records = [] # (path, status, service time in seconds)
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.debug(f'Mock server listening on {self.url}')
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_stats(self):
+        with self.lock:
+            self.records = []
+
+    def stats(self):
+        with self.lock:
+            records = list(self.records)
+        statuses = {}
+        for _, status, _ in records:
+            statuses[status] = statuses.get(status, 0) + 1
+        return {'requests': len(records), 'statuses': statuses}
+
+    def respond(self, method, path, query, body, request_headers=None):
+        """
+        Build (status, content type, payload, extra headers) for a request, after fault injection.
+        """
+        config = self.config
+        with self.lock:
+            error = self.rng.random() < config.error_rate
+            delay = self.latency.sample(self.rng)
+        if self.bucket is not None and not self.bucket.take():
+            return 429, 'text/plain', b'Too Many Requests', {'Retry-After': str(config.retry_after)}
+        if config.max_in_flight and self.in_flight > config.max_in_flight:
+            return 429, 'text/plain', b'Too Many Requests', {'Retry-After': str(config.retry_after)}
+        sleep(delay)
+        if error:
+            return 503, 'text/plain', b'Service Unavailable', {}
+
+        if path == MAP_PATH and method == 'POST':
+            form = parse_qs(body.decode())
+            if 'area' in form:
+                listings, total = self.data.area_listings(form['area'][0])
+                payload = json.dumps({'listings': listings, 'total': total}).encode()
+            else:
+                community = form.get('neighborhood[]', [''])[0]
+                payload = load_fixture(config.fixtures, 'map', f'{community}.json')
+                if payload is None:
+                    listings = self.data.community_listings(community)
+                    payload = json.dumps({'listings': listings, 'total': len(listings)}).encode()
+            if not config.etags:
+                return 200, 'application/json', payload, {}
+            etag = f'"{hashlib.sha256(payload).hexdigest()[:32]}"'
+            if (request_headers or {}).get('if-none-match') == etag:
+                return 304, 'application/json', b'', {'ETag': etag}
+            return 200, 'application/json', payload, {'ETag': etag}
+        if path == DIRECTORY_PATH:
+            return 200, 'text/html', load_fixture(config.fixtures, 'directory.html') or directory_html(config), {}
+        if path == PROFILE_PATH:
+            school_id = query.get('id', ['0'])[0]
+            return 200, 'text/html', load_fixture(config.fixtures, 'profile', f'{school_id}.html') or profile_html(int(school_id)), {}
+        if path == OVERLAYS_PATH and method == 'POST':
+            school_id = json.loads(body or b'{}').get('id', 0)
+            return 200, 'application/json', load_fixture(config.fixtures, 'overlays', f'{school_id}.json') or overlays_json(int(school_id)), {}
+        return 404, 'text/plain', b'Not Found', {}
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive, like the live servers
+
+            def handle_request(self, method):
+                start = perf_counter()
+                url = urlparse(self.path)
+                status = 500
+                with server.lock:
+                    server.in_flight += 1
+                try:
+                    length = int(self.headers.get('content-length') or 0)
+                    body = self.rfile.read(length) if length else b''
+                    status, content_type, payload, headers = server.respond(method, url.path, parse_qs(url.query), body, self.headers)
+                    self.send_response(status)
+                    self.send_header('content-type', content_type)
+                    self.send_header('content-length', str(len(payload)))
+                    for key, value in headers.items():
+                        self.send_header(key, value)
+                    self.end_headers()
+                    self.wfile.write(payload)
+                finally:
+                    with server.lock:
+                        server.in_flight -= 1
+                        server.records.append((url.path, status, perf_counter() - start))
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Local mock of the RentFaster and CBE endpoints')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_config_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def add_config_arguments(parser):
+    parser.add_argument('--latency', default='none', help="'none', 'fixed:S', 'uniform:LOW,HIGH' or 'lognormal:MEDIAN,SIGMA'")
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='requests per second before answering 429')
+    parser.add_argument('--burst', type=float, default=0.0, help='token bucket size of the rate limit')
+    parser.add_argument('--max-in-flight', type=int, default=0, help='concurrent requests before answering 429')
+    parser.add_argument('--fixtures', default='', help='directory with recorded responses')
+    parser.add_argument('--schools', type=int, default=250)
+    parser.add_argument('--no-etags', dest='etags', action='store_false', help='do not send ETags nor answer 304')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def config_from_args(args):
+    return MockConfig(latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit, burst=args.burst,
+                      max_in_flight=args.max_in_flight, fixtures=args.fixtures, schools=args.schools, etags=args.etags, seed=args.seed)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = MockServer(config_from_args(args), host=args.host, port=args.port)
+    logger.info(f'Mock server listening on {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
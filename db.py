@@ -0,0 +1,138 @@
+"""
+Connection factory for database.db, shared by the stages of the routine and the school scraper.
+
+Every connection is opened with the settings of a DBConfig: WAL journal, so the report notebook and the
+interactive tool can read while the routine writes, a relaxed synchronous level, a larger page cache,
+memory-mapped reads and in-memory temp tables (the staging tables of load_listing). Statements run through
+the connection are timed per stage, and a summary is logged when the connection is closed.
+"""
+import re
+import sqlite3
+from collections import defaultdict
+from dataclasses import dataclass, replace
+from time import perf_counter
+from loguru import logger
+
+
+@dataclass(frozen=True)
+class DBConfig:
+    """
+    Settings applied to every connection opened by `connect`.
+    """
+    path: str = 'database.db'
+    journal_mode: str = 'WAL' # persistent, readers do not block the writer and vice versa
+    synchronous: str = 'NORMAL' # with WAL, only a commit during a power loss can be lost, the database cannot be corrupted
+    cache_size: int = -64_000 # pages if positive, KiB if negative
+    mmap_size: int = 256 * 2**20 # bytes of the database file read through memory mapping
+    temp_store: str = 'MEMORY'
+    busy_timeout: float = 30.0 # seconds to wait for a lock held by another connection
+    timing: bool = True # record the time spent in each statement
+    top_statements: int = 5 # statements listed in the timing summary
+
+
+DB_CONFIG = DBConfig()
+
+
+def normalize_statement(sql):
+    """
+    Shorten a SQL statement to a key for the timing summary, e.g. 'INSERT INTO staging_listings (id, ...'.
+    """
+    return re.sub(r'\s+', ' ', sql).strip()[:80]
+
+
+class StatementTimings:
+    """
+    Number of executions, seconds and rows changed per statement of a stage.
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self.statements = defaultdict(lambda: [0, 0.0, 0])
+
+    def record(self, sql, seconds, rowcount):
+        stats = self.statements[normalize_statement(sql)]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += max(rowcount, 0)
+
+    @property
+    def total(self):
+        return sum(seconds for _, seconds, _ in self.statements.values())
+
+    def log_summary(self, top=5):
+        if not self.statements:
+            return
+        logger.info(f'{self.stage}: {sum(count for count, _, _ in self.statements.values())} statements took {self.total:.2f} seconds in SQLite')
+        slowest = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        for statement, (count, seconds, rows) in slowest:
+            logger.debug(f'{self.stage}: {seconds:.3f}s in {count} x {statement} ({rows} rows changed)')
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor recording the time spent in execute and executemany. Fetching rows is not included.
+    """
+    def execute(self, sql, parameters=()):
+        start = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.timings.record(sql, perf_counter() - start, self.rowcount)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.timings.record(sql, perf_counter() - start, self.rowcount)
+
+
+class Connection(sqlite3.Connection):
+    """
+    Connection which hands out TimedCursors, including for the shortcuts `execute` and `executemany`
+    and for pandas.read_sql_query, and logs its statement timings when closed.
+    """
+    def __init__(self, *args, stage='database', top_statements=5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = StatementTimings(stage)
+        self.top_statements = top_statements
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        self.timings.log_summary(self.top_statements)
+        self.timings.statements.clear() # a connection may be closed more than once
+        super().close()
+
+
+def connect(stage='database', config=None, **overrides):
+    """
+    Open a connection to the database with the settings of `config`.
+
+    :param stage: Name of the pipeline stage, used in the timing summary.
+    :param config: A DBConfig, DB_CONFIG by default.
+    :param overrides: DBConfig fields to change for this connection only, e.g. `synchronous='FULL'`.
+    :return: A sqlite3.Connection, with statement timing if enabled in the config.
+    """
+    config = replace(config or DB_CONFIG, **overrides)
+    if config.timing:
+        conn = sqlite3.connect(config.path, timeout=config.busy_timeout, factory=Connection, stage=stage, top_statements=config.top_statements)
+    else:
+        conn = sqlite3.connect(config.path, timeout=config.busy_timeout)
+    # journal_mode returns the mode in effect, which stays 'memory' for in-memory databases
+    journal_mode = conn.execute(f'PRAGMA journal_mode = {config.journal_mode}').fetchone()[0]
+    conn.execute(f'PRAGMA synchronous = {config.synchronous}')
+    conn.execute(f'PRAGMA cache_size = {int(config.cache_size)}')
+    conn.execute(f'PRAGMA mmap_size = {int(config.mmap_size)}')
+    conn.execute(f'PRAGMA temp_store = {config.temp_store}')
+    conn.execute(f'PRAGMA busy_timeout = {int(config.busy_timeout * 1000)}')
+    if config.timing:
+        conn.timings.statements.clear() # only time the statements of the stage
+    logger.debug(f'{stage}: connected to {config.path} (journal_mode = {journal_mode}, synchronous = {config.synchronous})')
+    return conn
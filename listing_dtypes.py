@@ -0,0 +1,48 @@
+"""
+Compact in-memory layout of the rental listings DataFrame, shared by the stages of the pipeline,
+and a per-stage memory report.
+
+Low-cardinality text columns are categoricals and links Arrow-backed strings (Python-backed if pyarrow
+is not installed). Coordinates stay float64: RentFaster coordinates carry 6+ decimals, which float32
+would round by up to half a metre, changing the stored values and the school zone matches near boundaries.
+"""
+import pandas as pd
+from loguru import logger
+
+try:
+    import pyarrow  # noqa: F401
+    STRING_DTYPE = pd.StringDtype('pyarrow')
+except ImportError:
+    STRING_DTYPE = pd.StringDtype()
+
+CATEGORY_COLUMNS = ['city', 'community', 'type'] # a handful of distinct values over all listings
+STRING_COLUMNS = ['link'] # one distinct value per listing
+
+
+def compact_listings(df):
+    """
+    Convert the columns of a listings DataFrame to the compact layout. Columns which are missing are skipped.
+
+    :param df: A listings DataFrame at any stage of the pipeline.
+    :return: A new DataFrame with the compact dtypes; `df` is not modified.
+    """
+    dtypes = {column: 'category' for column in CATEGORY_COLUMNS if column in df.columns}
+    dtypes.update({column: STRING_DTYPE for column in STRING_COLUMNS if column in df.columns})
+    return df.astype(dtypes)
+
+
+def log_memory_usage(df, stage):
+    """
+    Log the memory used by a DataFrame, including the strings it references, with the heaviest columns at debug level.
+
+    :param df: The DataFrame to measure.
+    :param stage: Name of the pipeline stage, used in the log message.
+    :return: The memory used in bytes.
+    """
+    usage = df.memory_usage(deep=True, index=True)
+    total = int(usage.sum())
+    logger.info(f'{stage}: {len(df)} rows use {total / 2**20:.2f} MB')
+    columns = usage.drop('Index').sort_values(ascending=False)
+    logger.debug(f'{stage} memory by column: ' + ', '.join(f'{column} ({df[column].dtype}) {size / 2**20:.2f} MB'
+                                                           for column, size in columns.head(5).items()))
+    return total
@@ -10,7 +10,23 @@ import csv
 from loguru import logger
 import pandera as pa
 from pandera.typing import DataFrame, Series
+from pandera.engines import pandas_engine
 import re
+import random
+import json
+import hashlib
+import os
+import functools
+import inspect
+import copy
+from dataclasses import dataclass, field, fields, asdict
+from collections import OrderedDict, deque
+from typing import Optional
+from listing_dtypes import compact_listings, log_memory_usage
+from db import connect
+from migrations import migrate, analyze
+from mapping_state import enqueue, invalidate, coordinates_moved
+from snapshot_archive import write_snapshot, write_active_snapshot
 
 ################
 # Load community list
@@ -41,7 +57,20 @@ def load_from_csv(file_path, column=0):
 
     return data_list
 
-COMM_LIST = load_from_csv('get_community_list/community_list.csv')
+COMM_LIST_PATH = 'get_community_list/community_list.csv'
+
+@functools.lru_cache(maxsize=None)
+def get_comm_list():
+    """
+    Return the list of communities, read from COMM_LIST_PATH on first use instead of at import time.
+    """
+    return load_from_csv(COMM_LIST_PATH)
+
+def __getattr__(name):
+    # COMM_LIST is still available as a module attribute, loaded lazily
+    if name == 'COMM_LIST':
+        return get_comm_list()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 ################
 # Declare DataFrameModel for data validation
@@ -50,13 +79,13 @@ class ExtractSchema(pa.DataFrameModel):
     """
     Schema for rental listings fetched from API
     """
-    id: Series[int] == pa.Field(nullable=False, unique=True) # as primary key, must be unique integer and not null
-    city: Series[str] = pa.Field(nullable=False) # to ensure the data retrieved is for the correct city, so not null
-    community: Series[str] = pa.Field(nullable=False, isin=COMM_LIST) # essential for mapping crime rate, so not null
+    id: Series[int] = pa.Field(nullable=False, unique=True) # as primary key, must be unique integer and not null
+    city: Series[pd.CategoricalDtype] = pa.Field(nullable=False) # to ensure the data retrieved is for the correct city, so not null
+    community: Series[pd.CategoricalDtype] = pa.Field(nullable=False) # essential for mapping crime rate, so not null, must be in the community list (see check below)
     latitude: Series[float] = pa.Field(nullable=False, ge=-90, le=90) # essential for matching schools, so not null, should be between -90 and 90
     longitude: Series[float] = pa.Field(nullable=False, ge=-180, le=180) # essential for matching schools, so not null, should be between -180 and 180
-    link: Series[str] = pa.Field(nullable=False, str_startswith= '/ab/calgary/rentals/') # essential for user to check out the listing on website, so not null, must start with '/ab/calgary/rentals/'
-    type: Series[str] = pa.Field(nullable=False) # essential for filtering, so not null
+    link: Series[pd.StringDtype] = pa.Field(nullable=False, str_startswith= '/ab/calgary/rentals/') # essential for user to check out the listing on website, so not null, must start with '/ab/calgary/rentals/'
+    type: Series[pd.CategoricalDtype] = pa.Field(nullable=False) # essential for filtering, so not null
     price: Series[int] = pa.Field(nullable=False, coerce= True) # main attribute for analysis, so reject null values
     beds: Series[str] = pa.Field(nullable=True,coerce=True) # Optional feature
     sq_feet: Series[str] = pa.Field(nullable=True,coerce=True) # Optional feature 
@@ -64,6 +93,11 @@ class ExtractSchema(pa.DataFrameModel):
     cats: Series[float]= pa.Field(nullable=True,ge=0,le=2)# Optional feature, set range between 0 and 2 inferred from data
     dogs: Series[float]= pa.Field(nullable=True,ge=0,le=2)# Optional feature, set range between 0 and 2 inferred from data
     
+    @pa.check('community', name='isin_community_list')
+    def community_in_list(cls, community: Series[pd.CategoricalDtype]) -> Series[bool]:
+        # Checked against the community list loaded on first validation rather than when the schema is declared
+        return community.isin(get_comm_list())
+    
     class Config:
         drop_invalid_rows = True
         strict = True #make sure all specified columns are in the validated dataframe
@@ -72,15 +106,15 @@ class TransformSchema(pa.DataFrameModel):
     """
     Schema for rental listings after data cleaning
     """
-    id: Series[int] == pa.Field(nullable=False, unique=True) # as primary key, must be unique integer and not null
-    city: Series[str] = pa.Field(nullable=False) # to ensure the data retrieved is for the correct city, so not null
-    community: Series[str] = pa.Field(nullable=False) # essential for mapping crime rate, so not null
+    id: Series[int] = pa.Field(nullable=False, unique=True) # as primary key, must be unique integer and not null
+    city: Series[pd.CategoricalDtype] = pa.Field(nullable=False) # to ensure the data retrieved is for the correct city, so not null
+    community: Series[pd.CategoricalDtype] = pa.Field(nullable=False) # essential for mapping crime rate, so not null
     latitude: Series[float] = pa.Field(nullable=False) # essential for matching schools, so not null
     longitude: Series[float] = pa.Field(nullable=False) # essential for matching schools, so not null
-    link: Series[str] = pa.Field(nullable=False) # essential for user to check out the listing on website, so not null
-    type: Series[str] = pa.Field(nullable=False) # essential for filtering, so not null
+    link: Series[pd.StringDtype] = pa.Field(nullable=False) # essential for user to check out the listing on website, so not null
+    type: Series[pd.CategoricalDtype] = pa.Field(nullable=False) # essential for filtering, so not null
     price: Series[int] = pa.Field(nullable=False, coerce = True) # main attribute for analysis, so reject null values
-    beds: Series[int] = pa.Field(nullable=True) # Optional feature
+    beds: Series[pd.Int8Dtype] = pa.Field(nullable=True) # Optional feature
     has_den: Series[bool] = pa.Field(nullable=False) # new columns from data cleaning
     sq_feet: Series[int] = pa.Field(nullable=True) # accepts None or pd.NA 
     baths: Series[float] = pa.Field(default = 0,ge =0,le=10, nullable=True)# Optional feature 
@@ -99,117 +133,1165 @@ class TransformSchema(pa.DataFrameModel):
 # Data extraction
 ################
 
-async def fetch_data_for_community(client, community, url, headers):
+# The URL endpoint for the API request
+MAP_URL = "https://www.rentfaster.ca/api/map.json"
+# Headers to mimic a user-agent and include other necessary information for the request
+HEADERS = {
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "accept-language": "en-US,en;q=0.9,zh-TW;q=0.8,zh;q=0.7",
+    "content-type": "application/x-www-form-urlencoded",
+    "origin": "https://www.rentfaster.ca",
+    "referer": "https://www.rentfaster.ca/"
+}
+
+# Fetch scheduler settings. Adjust these numbers based on server tolerance.
+MAX_CONCURRENT_REQUESTS = 10 # number of requests in flight at once
+MAX_CONNECTIONS = 10 # size of the connection pool
+MAX_KEEPALIVE_CONNECTIONS = 10 # idle connections kept open for reuse
+REQUEST_TIMEOUT = 30.0 # seconds allowed for each request
+CONNECT_TIMEOUT = 10.0 # seconds allowed to open a connection
+MAX_TRIES = 4 # attempts per community in each pass
+RETRY_BUDGET = 100 # retries shared by all communities in one run
+BACKOFF_BASE = 1.0 # seconds, doubled on every retry
+BACKOFF_MAX = 30.0 # upper bound of a single backoff sleep
+REFETCH_DELAY = 10.0 # seconds to wait before re-fetching failed communities
+REFETCH_CONCURRENT_REQUESTS = 2 # the re-fetch pass is gentler on the server
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Columns kept from the API response, in the order of ExtractSchema
+EXTRACT_COLUMNS = ['id', 'city', 'community', 'latitude', 'longitude', 'link', 'type', 'price', 'beds', 'sq_feet', 'baths', 'cats', 'dogs']
+# dtypes of the numeric columns, used when no listing changed and the DataFrame is empty
+EMPTY_EXTRACT_DTYPES = {'id': 'int64', 'latitude': 'float64', 'longitude': 'float64', 'price': 'int64', 'baths': 'float64', 'cats': 'float64', 'dogs': 'float64'}
+
+# Fingerprint cache settings. Communities whose response did not change since the last
+# successful load are not parsed, validated or written to the database.
+USE_FINGERPRINT_CACHE = True
+FINGERPRINT_CACHE_PATH = 'cache/fetch_fingerprints.json'
+FINGERPRINT_MAX_AGE_DAYS = 7 # entries older than this are ignored, forcing a full refresh of the community
+
+# Extraction mode: 'community' queries one neighborhood[] at a time, 'tile' covers the city with bounding boxes
+# built from the community boundaries, so listings near community borders are downloaded once.
+FETCH_MODE = 'community'
+COMMUNITY_BOUNDARIES_PATH = 'community_boundaries/Community_District_Boundaries_20231230.csv'
+TILE_PLAN_PATH = 'cache/tile_plan.json'
+TILE_AREA_PARAM = 'area' # form field of the map view bounding box, sent as 'north,east,south,west'
+TILE_GRID = 6 # initial grid is TILE_GRID x TILE_GRID tiles over the extent of the communities
+TILE_MAX_LISTINGS = 500 # a tile returning this many listings is assumed to be truncated and is split in four
+TILE_MAX_DEPTH = 6 # maximum number of splits of an initial tile
+TILE_MERGE_THRESHOLD = 150 # neighbouring tiles with fewer listings than this combined are merged for the next run
+TILE_MAX_REQUESTS = 1000 # tile requests allowed in one run, including re-fetches, before falling back to community mode
+
+
+@dataclass
+class FetchStats:
+    """
+    Outcome of one map.json request, for a community or a tile.
+    """
+    key: str # community name or tile key
+    status: str = 'pending' # 'ok' or 'failed'
+    attempts: int = 0
+    latency: float = 0.0 # seconds spent on the successful (or last) attempt
+    elapsed: float = 0.0 # seconds spent on the request including backoff sleeps
+    listings: int = 0
+    status_code: Optional[int] = None
+    error: str = ''
+    unchanged: bool = False # True when the response matched the fingerprint cache
+    truncated: bool = False # True when the response hit TILE_MAX_LISTINGS
+    ids: list = field(default_factory=list, repr=False) # listing ids of the response, compared between a tile and its children
+
+
+@dataclass
+class FetchReport:
+    """
+    Per-request fetch statistics collected by fetch_data.
+    
+    The load stage uses `failed_communities` to avoid deactivating listings of communities that could not be fetched,
+    and skips deactivation altogether when a tile failed (`complete` is False).
+    """
+    mode: str = 'community'
+    stats: dict = field(default_factory=dict)
+    retries_used: int = 0
+    received: int = 0 # listings downloaded, including duplicates
+    unique: int = 0 # listings with a unique 'id'
+    unchanged_ids: set = field(default_factory=set) # listings of unchanged responses, skipped by transform and load
+    cache: Optional['FingerprintCache'] = None
+    
+    @property
+    def failed_keys(self):
+        return [s.key for s in self.stats.values() if s.status != 'ok']
+    
+    @property
+    def failed_communities(self):
+        return self.failed_keys if self.mode == 'community' else []
+    
+    @property
+    def complete(self):
+        # Failed communities can be protected one by one, failed tiles cannot
+        return self.mode == 'community' or not self.failed_keys
+    
+    @property
+    def unchanged_keys(self):
+        return [s.key for s in self.stats.values() if s.unchanged]
+    
+    @property
+    def duplicate_ratio(self):
+        return (self.received - self.unique) / self.received if self.received else 0.0
+    
+    def to_frame(self):
+        return pd.DataFrame([asdict(s) for s in self.stats.values()], columns=[f.name for f in fields(FetchStats)]).drop(columns='ids')
+    
+    def log_summary(self):
+        df = self.to_frame()
+        if df.empty:
+            return
+        ok = df[df['status'] == 'ok']
+        logger.info(f'Fetched {len(ok)}/{len(df)} {self.mode} requests with {self.retries_used} retries, '
+                    f'latency p50 = {ok["latency"].quantile(0.5):.2f}s, p95 = {ok["latency"].quantile(0.95):.2f}s, max = {ok["latency"].max():.2f}s')
+        logger.info(f'Downloaded {self.received} listings, {self.unique} unique, duplicate ratio = {self.duplicate_ratio:.1%}')
+        if self.unchanged_keys:
+            logger.info(f'{len(self.unchanged_keys)} {self.mode} responses unchanged since the last run, skipping {len(self.unchanged_ids)} listings')
+        if self.failed_keys:
+            logger.warning(f'Failed to fetch {len(self.failed_keys)} {self.mode} requests: {self.failed_keys}')
+
+
+class FingerprintCache:
+    """
+    Local per-community cache of the last loaded response.
+    
+    Each entry stores the SHA-256 of the raw response body, a hash of the ExtractSchema columns of its listings,
+    the ETag/Last-Modified headers if the server sent them, and the listing ids. New entries are staged
+    during the fetch and only written by `save` once the load stage succeeded, so a failed run is fetched again.
+    """
+    def __init__(self, path=FINGERPRINT_CACHE_PATH, max_age_days=FINGERPRINT_MAX_AGE_DAYS):
+        self.path = path
+        self.max_age_days = max_age_days
+        self.entries = {}
+        self.pending = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as file:
+                    self.entries = json.load(file)
+            except (OSError, ValueError) as e:
+                logger.warning(f'Ignoring unreadable fingerprint cache {path}: {e}')
+    
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        age = datetime.now() - datetime.fromisoformat(entry['fetched_at'])
+        return entry if age.days < self.max_age_days else None
+    
+    def stage(self, key, response, content_hash, listings_hash, ids, fetched_at=None):
+        # fetched_at is kept from the old entry when only volatile fields changed, so the entry still expires
+        self.pending[key] = {
+            'content_hash': content_hash,
+            'listings_hash': listings_hash,
+            'etag': response.headers.get('etag'),
+            'last_modified': response.headers.get('last-modified'),
+            'ids': ids,
+            'fetched_at': fetched_at or datetime.now().isoformat(timespec='seconds')
+        }
+    
+    def save(self):
+        if not self.pending:
+            return
+        self.entries.update(self.pending)
+        self.pending = {}
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Write to a temporary file first so an interrupted run never leaves a truncated cache behind
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.entries, file)
+        os.replace(tmp_path, self.path)
+        logger.debug(f'Saved {len(self.entries)} fingerprints to {self.path}')
+
+
+def conditional_headers(headers, entry):
+    """
+    Add If-None-Match/If-Modified-Since to the request headers when the cached entry has validators.
+    """
+    if entry is None:
+        return headers
+    headers = dict(headers)
+    if entry.get('etag'):
+        headers['if-none-match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['if-modified-since'] = entry['last_modified']
+    return headers
+
+
+def listings_fingerprint(listings):
+    # Hash of the ExtractSchema columns only, so volatile fields elsewhere in the payload do not count as changes
+    rows = [[listing.get(column) for column in EXTRACT_COLUMNS] for listing in listings]
+    rows.sort(key=lambda row: str(row[0]))
+    return hashlib.sha256(json.dumps(rows, default=str).encode()).hexdigest()
+
+
+class ListingAccumulator:
+    """
+    Collects listings from many responses straight into one list per ExtractSchema column.
+    
+    Only the first occurrence of each listing 'id' is kept, so listings returned for several
+    communities are stored once and a single DataFrame is built at the end of the run.
     """
-    Asynchronously fetch rental data for a specific community using the provided url and headers.
+    def __init__(self, columns=EXTRACT_COLUMNS):
+        self.columns = columns
+        self.data = {column: [] for column in columns}
+        self.seen_ids = set()
+        self.received = 0 # number of listings received, including duplicates
+    
+    def __len__(self):
+        return len(self.seen_ids)
+    
+    def add(self, listings):
+        """
+        Append the listings of one response, skipping ids which were already collected.
+        
+        Args:
+        listings (list): The 'listings' array of a map.json response.
+        
+        Returns:
+        int: The number of new listings appended.
+        """
+        seen_ids = self.seen_ids
+        columns = [(column, self.data[column].append) for column in self.columns]
+        added = 0
+        for listing in listings:
+            listing_id = listing.get('id')
+            if listing_id in seen_ids:
+                continue
+            seen_ids.add(listing_id)
+            for column, append in columns:
+                append(listing.get(column))
+            added += 1
+        self.received += len(listings)
+        return added
+    
+    def to_frame(self):
+        # Text columns with few distinct values become categoricals, see listing_dtypes
+        return compact_listings(pd.DataFrame(self.data, columns=self.columns))
+
+
+class RetryBudget:
+    """
+    Caps the total number of retries in a run, so an outage fails fast instead of retrying every community MAX_TRIES times.
+    """
+    def __init__(self, retries):
+        self.remaining = retries
+        self.used = 0
+    
+    def acquire(self):
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        self.used += 1
+        return True
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Exponential backoff with full jitter. A Retry-After value sent by the server is used as the lower bound.
+    
+    Args:
+    attempt (int): The attempt that just failed, starting from 1.
+    retry_after (float): Seconds requested by the server, if any.
+    
+    Returns:
+    float: Seconds to sleep before the next attempt.
+    """
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, BACKOFF_MAX))
+    return delay
+
+
+def parse_retry_after(response):
+    # Only the delay-seconds form is handled; HTTP dates fall back to plain backoff
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+async def fetch_listings(client, key, data, url, headers, semaphore, budget, accumulator, max_tries=MAX_TRIES, cache=None):
+    """
+    Asynchronously fetch rental data for one map.json request using the provided url and headers,
+    and append the listings to the shared accumulator. When the response matches the fingerprint
+    cache, the listings are not parsed and the request is marked as unchanged.
+    Transient failures (timeouts, connection errors, 429 and 5xx responses, malformed JSON) are retried
+    with jittered exponential backoff while the shared retry budget lasts.
     
     Args:
     client (httpx.AsyncClient): The HTTP client for making requests.
-    community (str): The community name for which the data is being fetched.
+    key (str): The community name or tile key identifying the request.
+    data (dict): The form fields of the POST request.
     url (str): The endpoint URL for fetching data.
     headers (dict): The HTTP headers to be sent with the request.
+    semaphore (asyncio.Semaphore): Limits the number of requests in flight.
+    budget (RetryBudget): Retries shared by all requests in the run.
+    accumulator (ListingAccumulator): Collects the listings of all requests.
+    max_tries (int): Maximum number of attempts for this request.
+    cache (FingerprintCache): Optional fingerprint cache of the last loaded responses.
     
     Returns:
-    pandas.DataFrame: A DataFrame containing the rental data for the community.
+    FetchStats: Latency and outcome of the fetch.
     """
     
-    # Prepare the data payload with the community parameter for the POST request
-    data = {"neighborhood[]": community}
+    # Prepare the data payload for the POST request
     payload = urlencode(data)
+    stats = FetchStats(key)
+    start = perf_counter()
+    entry = cache.get(key) if cache is not None else None
+    headers = conditional_headers(headers, entry)
     
-    try:
-        # Send the POST request
-        response = await client.post(url, data=payload, headers=headers)
-        # Convert the JSON response into a DataFrame
-        df = pd.DataFrame.from_records(response.json()['listings'])
+    while True:
+        stats.attempts += 1
+        retry_after = None
+        retryable = True
+        try:
+            # Only hold a slot while the request is in flight, not while backing off
+            async with semaphore:
+                attempt_start = perf_counter()
+                try:
+                    # Send the POST request
+                    response = await client.post(url, data=payload, headers=headers)
+                finally:
+                    stats.latency = perf_counter() - attempt_start
+            stats.status_code = response.status_code
+            if response.status_code == 304 and entry is not None:
+                # Not modified since the validators of the cached entry. httpx counts 3xx replies as errors,
+                # so this is checked before raise_for_status
+                not_modified = True
+            else:
+                response.raise_for_status()
+                content_hash = hashlib.sha256(response.content).hexdigest() if cache is not None else None
+                not_modified = entry is not None and content_hash == entry['content_hash']
+            
+            if not_modified:
+                # Same payload as the last successful load, skip parsing altogether
+                stats.unchanged = True
+                listings = None
+            else:
+                body = response.json()
+                listings = body['listings']
+                total = body.get('total')
+                stats.truncated = isinstance(total, int) and total > len(listings)
+                if cache is not None:
+                    listings_hash = listings_fingerprint(listings)
+                    stats.unchanged = entry is not None and listings_hash == entry['listings_hash']
+                    cache.stage(key, response, content_hash, listings_hash, [listing.get('id') for listing in listings],
+                                fetched_at=entry['fetched_at'] if stats.unchanged else None)
+            
+            stats.status = 'ok'
+            stats.elapsed = perf_counter() - start
+            if stats.unchanged:
+                stats.ids = entry['ids']
+                stats.listings = len(entry['ids'])
+                stats.truncated = stats.truncated or stats.listings >= TILE_MAX_LISTINGS
+                logger.debug(f"Listings for {key} unchanged ({stats.latency:.2f}s, attempt {stats.attempts})")
+                return stats
+            
+            # Append only the ExtractSchema columns of unseen listings
+            added = accumulator.add(listings)
+            stats.ids = [listing.get('id') for listing in listings]
+            stats.listings = len(listings)
+            stats.truncated = stats.truncated or stats.listings >= TILE_MAX_LISTINGS
+            logger.debug(f"Number of listings for {key}: {len(listings)}, {added} new ({stats.latency:.2f}s, attempt {stats.attempts})")
+            return stats
+        except httpx.HTTPStatusError as e:
+            stats.error = f'HTTP {e.response.status_code}'
+            retryable = e.response.status_code in RETRY_STATUS_CODES
+            retry_after = parse_retry_after(e.response)
+        except (httpx.TransportError, ValueError, KeyError) as e:
+            # Timeouts, connection errors and truncated or unexpected JSON payloads
+            stats.error = f'{type(e).__name__}: {e}'
+        except Exception as e:
+            stats.error = f'{type(e).__name__}: {e}'
+            retryable = False
         
-        logger.debug(f"Number of listings for {community}: {len(df)}")
+        if not retryable or stats.attempts >= max_tries or not budget.acquire():
+            break
+        delay = backoff_delay(stats.attempts, retry_after)
+        logger.debug(f"Retrying {key} in {delay:.2f}s after attempt {stats.attempts} failed: {stats.error}")
+        await asyncio.sleep(delay)
+    
+    # Log the failure once the request is out of attempts
+    stats.status = 'failed'
+    stats.elapsed = perf_counter() - start
+    logger.error(f"Error fetching data for {key} after {stats.attempts} attempts: {stats.error}")
+    return stats
+
+
+async def fetch_data_for_community(client, community, url, headers, semaphore, budget, accumulator, max_tries=MAX_TRIES, cache=None):
+    """
+    Asynchronously fetch rental data for a specific community, see fetch_listings.
+    """
+    # The data payload with the community parameter for the POST request
+    data = {"neighborhood[]": community}
+    return await fetch_listings(client, community, data, url, headers, semaphore, budget, accumulator, max_tries, cache)
+
+
+async def fetch_batch(client, requests, budget, concurrency, accumulator, max_tries=MAX_TRIES, cache=None):
+    """
+    Fetch a batch of map.json requests with at most `concurrency` requests in flight.
+    
+    Args:
+    requests (dict): Form fields of each request, keyed by community name or tile key.
+    
+    Returns:
+    list: FetchStats in the order of `requests`.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [fetch_listings(client, key, data, MAP_URL, HEADERS, semaphore, budget, accumulator, max_tries, cache) for key, data in requests.items()]
+    return await asyncio.gather(*tasks)
+
+
+################
+# Spatial tiling
+################
+# A tile is a (west, south, east, north) bounding box in degrees.
+
+def tile_key(tile):
+    return ','.join(f'{value:.6f}' for value in tile)
+
+
+def tile_request(tile):
+    west, south, east, north = tile
+    return {TILE_AREA_PARAM: f'{north},{east},{south},{west}'}
+
+
+def split_tile(tile):
+    west, south, east, north = tile
+    mid_x, mid_y = (west + east) / 2, (south + north) / 2
+    return [(west, south, mid_x, mid_y), (mid_x, south, east, mid_y), (west, mid_y, mid_x, north), (mid_x, mid_y, east, north)]
+
+
+def initial_tiles(path=None, grid=None):
+    """
+    Cover the extent of the community boundaries with a grid, keeping only tiles which overlap a community.
+    
+    Returns:
+    list: (west, south, east, north) tiles.
+    """
+    import shapely
+    from shapely import wkt
+    
+    path = path or COMMUNITY_BOUNDARIES_PATH
+    grid = grid or TILE_GRID
+    boundaries = pd.read_csv(path, usecols=['MULTIPOLYGON'])
+    communities = shapely.union_all([wkt.loads(polygon) for polygon in boundaries['MULTIPOLYGON']])
+    west, south, east, north = communities.bounds
+    width, height = (east - west) / grid, (north - south) / grid
+    tiles = [(west + i * width, south + j * height, west + (i + 1) * width, south + (j + 1) * height)
+             for j in range(grid) for i in range(grid)]
+    return [tile for tile in tiles if communities.intersects(shapely.box(*tile))]
+
+
+def load_tile_plan(path=None):
+    """
+    Load the tiles refined by the previous run, or build the initial grid.
+    """
+    path = path or TILE_PLAN_PATH
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as file:
+            return [tuple(tile['bounds']) for tile in json.load(file)]
+    return initial_tiles()
+
+
+def merge_sparse_tiles(counts, threshold=None):
+    """
+    Greedily merge neighbouring tiles which share a full edge and hold fewer than `threshold` listings together.
+    The tiles are indexed by their edges, so each tile and each merged tile looks up its four neighbours once.
+    
+    Args:
+    counts (dict): Number of listings of each tile.
+    
+    Returns:
+    dict: The merged tiles and their listing counts.
+    """
+    threshold = threshold or TILE_MERGE_THRESHOLD
+    counts = dict(counts)
+    # Tiles by their west, east, south and north edge
+    edges = ({}, {}, {}, {})
+    
+    def edge_keys(tile):
+        west, south, east, north = tile
+        return (west, south, north), (east, south, north), (south, west, east), (north, west, east)
+    
+    def add(tile):
+        for index, key in zip(edges, edge_keys(tile)):
+            index[key] = tile
+    
+    def remove(tile):
+        for index, key in zip(edges, edge_keys(tile)):
+            del index[key]
+    
+    for tile in counts:
+        add(tile)
+    queue = deque(sorted(counts))
+    while queue:
+        tile = queue.popleft()
+        if tile not in counts:
+            continue # merged into a larger tile already
+        west_edge, east_edge, south_edge, north_edge = edge_keys(tile)
+        # The east neighbour's west edge is this tile's east edge, and so on
+        neighbours = [edges[0].get(east_edge), edges[1].get(west_edge), edges[2].get(north_edge), edges[3].get(south_edge)]
+        for other in neighbours:
+            if other is None or counts[tile] + counts[other] >= threshold:
+                continue
+            combined = (min(tile[0], other[0]), min(tile[1], other[1]), max(tile[2], other[2]), max(tile[3], other[3]))
+            remove(tile)
+            remove(other)
+            add(combined)
+            counts[combined] = counts.pop(tile) + counts.pop(other)
+            queue.append(combined)
+            break
+    return counts
+
+
+def save_tile_plan(counts, path=None):
+    path = path or TILE_PLAN_PATH
+    plan = merge_sparse_tiles(counts)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump([{'bounds': list(tile), 'listings': count} for tile, count in sorted(plan.items())], file)
+    logger.debug(f'Saved tile plan with {len(plan)} tiles ({len(counts)} before merging) to {path}')
+
+
+async def fetch_tiles(client, tiles, budget, accumulator, cache=None, max_requests=None):
+    """
+    Fetch every tile, splitting truncated tiles in four until they fit in one response or TILE_MAX_DEPTH is reached.
+    Failed tiles are re-fetched once at lower concurrency.
+    
+    The tiles are given up on when the next level of splits would exceed `max_requests`, or when the four
+    children of a tile return the same listings as the tile itself, which means the server ignores TILE_AREA_PARAM
+    and splitting further would only repeat the same capped response.
+    
+    Returns:
+    tuple: FetchStats of every request, and the listing count of each leaf tile for the next tile plan,
+    or None instead of the counts when the tiles were given up on.
+    """
+    max_requests = max_requests or TILE_MAX_REQUESTS
+    results = []
+    counts = {}
+    sent = 0
+    pending = {tile: 0 for tile in tiles} # tile -> depth
+    parent_ids = {} # split tile -> ids of the listings it returned
+    while pending:
+        if sent + len(pending) > max_requests:
+            logger.warning(f'Fetching {len(pending)} more tiles would exceed the budget of {max_requests} tile requests ({sent} sent)')
+            return results, None
+        requests = {tile_key(tile): tile_request(tile) for tile in pending}
+        level = await fetch_batch(client, requests, budget, MAX_CONCURRENT_REQUESTS, accumulator, cache=cache)
+        sent += len(level)
         
-        # If there are listings, select specific columns
-        if not df.empty:
-            return df[['id', 'city', 'community', 'latitude', 'longitude', 'link', 'type', 'price', 'beds', 'sq_feet', 'baths', 'cats', 'dogs']]
-        else:
-            # If the DataFrame is empty, return an empty DataFrame with no columns
-            # This is useful for concatenating results later without extra checks
-            return pd.DataFrame()
-    except Exception as e:
-        # Log the exception if the request fails
-        logger.exception(f"Error fetching data for {community}: {e}")
-        return pd.DataFrame()
+        failed = {tile: depth for (tile, depth), stats in zip(pending.items(), level) if stats.status != 'ok'}
+        if failed:
+            logger.warning(f'Re-fetching {len(failed)} failed tiles in {REFETCH_DELAY:.0f}s')
+            await asyncio.sleep(REFETCH_DELAY)
+            refetched = await fetch_batch(client, {tile_key(tile): tile_request(tile) for tile in failed}, budget,
+                                          REFETCH_CONCURRENT_REQUESTS, accumulator, cache=cache)
+            sent += len(refetched)
+            refetched = {stats.key: stats for stats in refetched}
+            level = [refetched.get(stats.key, stats) for stats in level]
+        results.extend(level)
+        
+        # Children are fetched in groups of four after their parent
+        stats_by_tile = dict(zip(pending, level))
+        for parent, ids in parent_ids.items():
+            children = [stats_by_tile[child] for child in split_tile(parent)]
+            if all(stats.status == 'ok' and set(stats.ids) == ids for stats in children):
+                logger.warning(f'The children of tile {tile_key(parent)} returned the same {len(ids)} listings, '
+                               f"the server seems to ignore '{TILE_AREA_PARAM}'")
+                return results, None
+        
+        next_pending = {}
+        parent_ids = {}
+        for (tile, depth), stats in zip(pending.items(), level):
+            if stats.truncated and depth < TILE_MAX_DEPTH:
+                next_pending.update({child: depth + 1 for child in split_tile(tile)})
+                parent_ids[tile] = set(stats.ids)
+            elif stats.status == 'ok':
+                counts[tile] = stats.listings
+            else:
+                counts[tile] = TILE_MERGE_THRESHOLD # keep failed tiles as they are in the next plan
+            if stats.truncated and depth >= TILE_MAX_DEPTH:
+                logger.warning(f'Tile {stats.key} still truncated at depth {depth}, some listings may be missing')
+        pending = next_pending
+    return results, counts
+
 
-@pa.check_types(lazy=True)
-async def fetch_data() -> DataFrame[ExtractSchema]:
+async def fetch_communities(client, budget, accumulator, cache=None):
     """
-    Fetch rental data for a list of communities concurrently and compile it into a single DataFrame.
+    Fetch every community in the community list, then re-fetch the failed communities once at lower concurrency.
+    
+    Returns:
+    list: FetchStats of every community.
+    """
+    requests = {community: {"neighborhood[]": community} for community in get_comm_list()}
+    results = await fetch_batch(client, requests, budget, MAX_CONCURRENT_REQUESTS, accumulator, cache=cache)
+    
+    # Targeted re-fetch pass for the communities which failed
+    failed = {stats.key: requests[stats.key] for stats in results if stats.status != 'ok'}
+    if failed:
+        logger.warning(f'Re-fetching {len(failed)} failed communities in {REFETCH_DELAY:.0f}s')
+        await asyncio.sleep(REFETCH_DELAY)
+        refetched = await fetch_batch(client, failed, budget, REFETCH_CONCURRENT_REQUESTS, accumulator, cache=cache)
+        refetched = {stats.key: stats for stats in refetched}
+        results = [refetched.get(stats.key, stats) for stats in results]
+    return results
+
+
+async def fetch_data(report=None) -> DataFrame[ExtractSchema]:
+    """
+    Fetch rental data for a list of communities (or tiles, see FETCH_MODE) concurrently and compile it into a single DataFrame.
+    Requests which still fail after retrying are re-fetched once more at lower concurrency at the end of the run.
+    When the tiles are given up on (see fetch_tiles), the run falls back to community mode.
+    Responses unchanged since the last successful load are left out of the DataFrame; their ids are
+    collected in `report.unchanged_ids` instead.
+    
+    Args:
+    report (FetchReport): Optional report to be filled with per-community latency and outcome stats.
     
     Returns:
     pandas.DataFrame: A DataFrame containing all the unique rental listings fetched.
     """
-    # The URL endpoint for the API request
-    url = "https://www.rentfaster.ca/api/map.json"
-    # Headers to mimic a user-agent and include other necessary information for the request
-    headers = {
-        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "accept-language": "en-US,en;q=0.9,zh-TW;q=0.8,zh;q=0.7",
-        "content-type": "application/x-www-form-urlencoded",
-        "origin": "https://www.rentfaster.ca",
-        "referer": "https://www.rentfaster.ca/"
-    }
-    
-    tasks = []
+    report = report if report is not None else FetchReport()
+    report.mode = FETCH_MODE
+    budget = RetryBudget(RETRY_BUDGET)
+    accumulator = ListingAccumulator()
+    cache = FingerprintCache() if USE_FINGERPRINT_CACHE else None
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)
+    timeout = httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+    
     # Create an asynchronous HTTP client session
-    async with httpx.AsyncClient() as client:
-        # Create a list of coroutines for each community in the global COMM_LIST
-        tasks = [fetch_data_for_community(client, community, url, headers) for community in COMM_LIST]
-        
-        # Asynchronously gather all data from the tasks
-        dataframes = await asyncio.gather(*tasks)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        tile_counts = None
+        if FETCH_MODE == 'tile':
+            # Cover the city with the tiles refined by the previous run
+            results, tile_counts = await fetch_tiles(client, load_tile_plan(), budget, accumulator, cache=cache)
+            if tile_counts is not None:
+                save_tile_plan(tile_counts)
+            else:
+                # Listings fetched with the tiles stay in the accumulator, the communities cover the whole city again
+                logger.warning(f'Falling back to community mode after {len(results)} tile requests')
+                report.mode = 'community'
+        if tile_counts is None:
+            # Fetch every community in the community list
+            results = await fetch_communities(client, budget, accumulator, cache=cache)
     
-    # Combine all non-empty DataFrames into one and remove duplicate listings based on 'id'
-    final_df = pd.concat([df for df in dataframes if not df.empty], ignore_index=True)
-    final_df.drop_duplicates(inplace=True, subset='id')
+    report.stats = {stats.key: stats for stats in results}
+    report.retries_used = budget.used
+    report.received = accumulator.received
+    report.unique = len(accumulator)
+    report.cache = cache
+    if cache is not None:
+        report.unchanged_ids = {listing_id for stats in results if stats.unchanged
+                                for listing_id in (cache.pending.get(stats.key) or cache.get(stats.key))['ids']}
+    report.log_summary()
+    report.to_frame().to_csv(f'log/fetch_stats_{datetime.now().strftime("%Y_%m_%d")}.csv', index=False)
     
-    # Log the total number of unique listings fetched
-    logger.info(f"Total number of listings with unique 'id' fetched: {len(final_df)}")
+    if not len(accumulator) and not report.unchanged_ids:
+        raise RuntimeError('No listings fetched')
+    
+    # Build one DataFrame from the collected columns; duplicate listings were already skipped based on 'id'
+    final_df = accumulator.to_frame()
+    if final_df.empty:
+        final_df = final_df.astype(EMPTY_EXTRACT_DTYPES)
     
-    # Save the final DataFrame to a CSV file for debugging
-    final_df.to_csv('listing_df_raw.csv')
+    # Log the total number of unique listings fetched
+    logger.info(f"Total number of listings with unique 'id' fetched: {len(final_df)} ({accumulator.received - len(final_df)} duplicates skipped)")
     
     # Return the final compiled DataFrame
     return final_df
+################
+# Data validation
+################
+
+VALIDATION_MODE = 'incremental' # 'full' checks every listing with pandera, 'incremental' only the listings which are new or changed since the last load
+VALIDATION_CACHE_PATH = 'cache/validated_rows.npz'
+VALIDATOR_VERSION = 1 # bump to discard the validation cache when the checks change in a way the schema signatures do not show
+
+# Range checks of pandera which are compiled into NumPy comparisons: check name -> (statistic, comparison)
+RANGE_CHECKS = {
+    'greater_than_or_equal_to': ('min_value', np.greater_equal),
+    'less_than_or_equal_to': ('max_value', np.less_equal),
+    'greater_than': ('min_value', np.greater),
+    'less_than': ('max_value', np.less),
+}
+
+# Columns of the failure cases reported by pandera.errors.SchemaErrors
+FAILURE_CASE_COLUMNS = ['schema_context', 'column', 'check', 'check_number', 'failure_case', 'index']
+
+
+def schema_signature(model):
+    """
+    Text describing the columns and checks of a DataFrameModel, used to notice when the schema changes.
+    """
+    schema = model.to_schema()
+    return '\n'.join(f'{name} {column.dtype} nullable={column.nullable} unique={column.unique} coerce={column.coerce} '
+                     f'{[(check.name, check.statistics) for check in column.checks]}'
+                     for name, column in schema.columns.items())
+
+
+def validation_key():
+    """
+    Fingerprint of the schemas, the community list, the parsers and transform_df. Cached validation results are
+    only reused while it is unchanged, so a listing seen before is checked again once its transformed values may differ.
+    """
+    digest = hashlib.sha256()
+    versions = [version for _, version in sorted(parser_versions().items())]
+    for part in (str(VALIDATOR_VERSION), schema_signature(ExtractSchema), schema_signature(TransformSchema), *versions, *sorted(get_comm_list())):
+        digest.update(part.encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+def row_hashes(df_listings):
+    """
+    64-bit hash of the extracted columns of each listing.
+    """
+    return pd.util.hash_pandas_object(df_listings[EXTRACT_COLUMNS], index=False).to_numpy()
+
+
+class ValidationCache:
+    """
+    Ids and row hashes of the listings which passed validation in the last successful load.
+    
+    A listing with the same id and row hash as then is still valid, so only the other listings need the
+    row level checks. The cache is discarded when the schemas, the community list, the parsers or transform_df change.
+    """
+    
+    def __init__(self, path=None):
+        self.path = path or VALIDATION_CACHE_PATH
+        self.key = validation_key()
+        self.ids = np.empty(0, dtype='int64')
+        self.hashes = np.empty(0, dtype='uint64')
+        self.delta_ids = np.empty(0, dtype='int64') # listings checked in full by validate_extract, validate_transform checks the same ones
+        self.pending = None
+        if os.path.exists(self.path):
+            try:
+                with np.load(self.path) as stored:
+                    if str(stored['key']) == self.key:
+                        self.ids, self.hashes = stored['ids'], stored['hashes']
+                    else:
+                        logger.info('Schemas or community list changed since the last load, validating every listing')
+            except (OSError, KeyError, ValueError) as e:
+                logger.warning(f'Ignoring unreadable validation cache {self.path}: {e}')
+        self.index = pd.Index(self.ids)
+    
+    def changed(self, ids, hashes):
+        """
+        Boolean mask of the listings which are new or changed since the cached load.
+        """
+        if not len(self.ids):
+            return np.ones(len(ids), dtype=bool)
+        positions = self.index.get_indexer(ids)
+        return (positions < 0) | (self.hashes[positions] != hashes)
+    
+    def stage(self, ids, hashes):
+        """
+        Remember the listings which passed validation in this run, written by save() once they are loaded.
+        """
+        self.pending = (np.asarray(ids, dtype='int64'), np.asarray(hashes, dtype='uint64'))
+    
+    def unstage(self, ids):
+        """
+        Forget staged listings which failed a later check.
+        """
+        if self.pending is not None:
+            keep = ~np.isin(self.pending[0], list(ids))
+            self.pending = (self.pending[0][keep], self.pending[1][keep])
+    
+    def save(self, keep_ids=()):
+        """
+        Write the staged listings, plus the cached ones in `keep_ids` which were not fetched because they are unchanged.
+        """
+        if self.pending is None:
+            return
+        ids, hashes = self.pending
+        kept = self.index.isin(list(keep_ids)) & ~self.index.isin(ids)
+        ids, hashes = np.concatenate([ids, self.ids[kept]]), np.concatenate([hashes, self.hashes[kept]])
+        
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.tmp.npz'
+        np.savez(tmp_path, key=np.array(self.key), ids=ids, hashes=hashes)
+        os.replace(tmp_path, self.path)
+        logger.debug(f'Saved the validation state of {len(ids)} listings to {self.path}')
+
+
+def compile_check(check):
+    """
+    Turn a pandera column check into a function returning a boolean array, True where a value passes.
+    
+    Range checks become NumPy comparisons and the community list check a lookup in a prebuilt hash index.
+    Other checks are run through pandera. As in pandera, null values pass every check but 'not_nullable'.
+    """
+    if check.name in RANGE_CHECKS:
+        statistic, compare = RANGE_CHECKS[check.name]
+        bound = check.statistics[statistic]
+        def valid(values):
+            values = values.to_numpy(dtype='float64', na_value=np.nan)
+            with np.errstate(invalid='ignore'):
+                return compare(values, bound) | np.isnan(values)
+    elif check.name == 'str_startswith':
+        prefix = check.statistics['string']
+        def valid(values):
+            return values.str.startswith(prefix).fillna(True).to_numpy(dtype=bool)
+    elif check.name == 'isin_community_list':
+        communities = pd.Index(get_comm_list())
+        def valid(values):
+            return (communities.get_indexer(values) >= 0) | values.isna().to_numpy()
+    else:
+        def valid(values):
+            return (check(values).check_output | values.isna()).to_numpy(dtype=bool)
+    return valid
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_checks(model):
+    """
+    The column checks of a DataFrameModel as a list of (column, function), see compile_check.
+    """
+    checks = []
+    for name, column in model.to_schema().columns.items():
+        if not column.nullable:
+            checks.append((name, lambda values: values.notna().to_numpy()))
+        checks.extend((name, compile_check(check)) for check in column.checks)
+    return checks
+
+
+def find_failures(model, df, rows):
+    """
+    Boolean mask of the rows of `df` failing the checks of a DataFrameModel.
+    
+    The row checks only run on the rows selected by the boolean array `rows`; uniqueness involves every row.
+    Returns None when the fast path cannot tell: the columns or dtypes of `df` differ from the schema, or the
+    schema has DataFrame level checks.
+    """
+    schema = model.to_schema()
+    if set(df.columns) != set(schema.columns) or schema.checks or schema.unique:
+        return None
+    for name, column in schema.columns.items():
+        try:
+            if column.dtype is not None and not column.dtype.check(pandas_engine.Engine.dtype(df[name].dtype)):
+                return None
+        except TypeError:
+            return None
+    
+    failing = np.zeros(len(df), dtype=bool)
+    for name, column in schema.columns.items():
+        if column.unique:
+            failing |= df[name].duplicated(keep=False).to_numpy()
+    
+    positions = np.flatnonzero(rows)
+    subset = df.iloc[positions]
+    subset_failing = np.zeros(len(positions), dtype=bool)
+    for name, valid in compiled_checks(model):
+        subset_failing |= ~valid(subset[name])
+    failing[positions] |= subset_failing
+    return failing
+
+
+def pandera_validate(schema, df):
+    """
+    Validate with pandera, separating the invalid rows instead of silently dropping them.
+    
+    :return: The valid rows, and the failure cases of the invalid ones (empty if all rows are valid).
+    :raises pa.errors.SchemaErrors: If a failure is not tied to a row, e.g. a missing column or a dtype which cannot be coerced.
+    """
+    schema = copy.copy(schema)
+    schema.drop_invalid_rows = False
+    try:
+        return schema.validate(df, lazy=True), pd.DataFrame(columns=FAILURE_CASE_COLUMNS)
+    except pa.errors.SchemaErrors as err:
+        if err.failure_cases['index'].isna().any():
+            raise
+        return err.data[~err.data.index.isin(err.failure_cases['index'])], err.failure_cases
+
+
+def validate_extract(df_listings, cache=None):
+    """
+    Validate fetched listings against ExtractSchema and drop the invalid ones.
+    
+    With a ValidationCache, listings with the same id and row hash as in the last successful load are
+    trusted and only the new or changed ones go through the row level checks, compiled into vectorized
+    functions. The columns, their dtypes and the uniqueness of 'id' are still checked on every row. Rows
+    failing the fast checks are validated again by pandera, so the failure cases are pandera's own.
+    
+    :param df_listings: DataFrame returned by fetch_data.
+    :param cache: Optional ValidationCache, staged with the listings which passed.
+    :return: The valid listings, and the failure cases of the dropped ones as in pandera's SchemaErrors.failure_cases.
+    :raises pa.errors.SchemaErrors: If the DataFrame as a whole is invalid, e.g. a column is missing or cannot be coerced.
+    """
+    start = perf_counter()
+    schema = ExtractSchema.to_schema()
+    if cache is None:
+        df_valid, failure_cases = pandera_validate(schema, df_listings)
+    else:
+        ids, hashes = df_listings['id'].to_numpy(), row_hashes(df_listings)
+        changed = cache.changed(ids, hashes)
+        try:
+            coerced = df_listings.copy(deep=False)
+            for name, column in schema.columns.items():
+                if column.coerce:
+                    coerced[name] = column.coerce_dtype(coerced[name])
+            failing = find_failures(ExtractSchema, coerced, changed)
+        except pa.errors.SchemaError:
+            failing = None
+        
+        if failing is None:
+            # Not a row level problem, let pandera validate and report on the whole DataFrame
+            df_valid, failure_cases = pandera_validate(schema, df_listings)
+        elif failing.any():
+            _, failure_cases = pandera_validate(schema, df_listings[failing])
+            df_valid = coerced[~coerced.index.isin(failure_cases['index'])]
+        else:
+            df_valid, failure_cases = coerced, pd.DataFrame(columns=FAILURE_CASE_COLUMNS)
+        
+        valid = df_listings.index.isin(df_valid.index)
+        cache.stage(ids[valid], hashes[valid])
+        cache.delta_ids = ids[valid & changed]
+        logger.debug(f'{changed.sum()} of {len(df_listings)} listings are new or changed since the last load')
+    
+    if not failure_cases.empty:
+        logger.warning(f'Dropped {len(df_listings) - len(df_valid)} listings which failed validation:\n'
+                       f'{failure_cases.groupby(["column", "check"]).size().to_string()}')
+    logger.debug(f'Validated listings against ExtractSchema in {perf_counter() - start:.4f} seconds')
+    return df_valid, failure_cases
+
+
+def validate_transform(df_listings, cache=None):
+    """
+    Validate transformed listings against TransformSchema and separate the invalid ones.
+    
+    With a ValidationCache, only the listings checked in full by validate_extract go through the row level
+    checks; the columns, dtypes and uniqueness are checked on every row. Rows failing the fast checks are
+    validated again by pandera, so the failure cases are pandera's own. Invalid listings are also removed
+    from the listings staged in the cache.
+    
+    :param df_listings: DataFrame returned by transform_df.
+    :param cache: Optional ValidationCache used by validate_extract in the same run.
+    :return: The valid listings, and the failure cases of the invalid ones as in pandera's SchemaErrors.failure_cases.
+    :raises pa.errors.SchemaErrors: If the DataFrame as a whole is invalid, e.g. a column is missing or has the wrong dtype.
+    """
+    start = perf_counter()
+    schema = TransformSchema.to_schema()
+    failing = None
+    if cache is not None:
+        failing = find_failures(TransformSchema, df_listings, df_listings['id'].isin(cache.delta_ids).to_numpy())
+    
+    if failing is None:
+        df_valid, failure_cases = pandera_validate(schema, df_listings)
+    elif failing.any():
+        _, failure_cases = pandera_validate(schema, df_listings[failing])
+        df_valid = df_listings[~df_listings.index.isin(failure_cases['index'])]
+    else:
+        df_valid, failure_cases = df_listings, pd.DataFrame(columns=FAILURE_CASE_COLUMNS)
+    
+    if not failure_cases.empty:
+        if cache is not None:
+            cache.unstage(df_listings.loc[~df_listings.index.isin(df_valid.index), 'id'])
+        logger.warning(f'Dropped {len(df_listings) - len(df_valid)} transformed listings which failed validation:\n'
+                       f'{failure_cases.groupby(["column", "check"]).size().to_string()}')
+    logger.debug(f'Validated listings against TransformSchema in {perf_counter() - start:.4f} seconds')
+    return df_valid, failure_cases
+
+
 ################
 # Data Cleaning and Transformation
 ################
 
+USE_PARSE_MEMO = True
+PARSE_MEMO_PATH = 'cache/parse_memo.json'
+PARSE_MEMO_SIZE = 20000 # distinct raw values remembered per column, least recently used ones are evicted first
+PARSE_MEMO_VERSION = 1 # bump to discard the memo when a parser changes in a way its source does not show
+
+# Marks a value missing from a ParseMemo, as None is a valid parsed value
+MISSING = object()
+
+class ParseMemo:
+    """
+    Bounded LRU memo of raw string -> parsed values of one column, with hit and miss counters.
+    """
+    
+    def __init__(self, version, entries=(), max_size=None):
+        self.version = version
+        self.max_size = max_size or PARSE_MEMO_SIZE
+        self.entries = OrderedDict(entries) # least recently used first
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def get(self, raw):
+        parsed = self.entries.get(raw, MISSING)
+        if parsed is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(raw)
+        return parsed
+    
+    def put(self, raw, parsed):
+        self.entries[raw] = parsed
+        self.entries.move_to_end(raw)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+def parser_version(*parts):
+    """
+    Version of a parser: a hash of the source of its functions and of its regular expressions, plus PARSE_MEMO_VERSION.
+    """
+    digest = hashlib.sha256(str(PARSE_MEMO_VERSION).encode('utf-8'))
+    for part in parts:
+        if isinstance(part, re.Pattern):
+            text = f'{part.pattern} {part.flags}'
+        else:
+            try:
+                text = inspect.getsource(part)
+            except (OSError, TypeError):
+                text = part.__qualname__
+        digest.update(text.encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+def parser_versions():
+    """
+    Version of each parser of transform_df, keyed by column, and of transform_df itself with its column cleaners.
+    """
+    return {'sq_feet': parser_version(parse_sq_feet_values, SQ_FEET_PATTERN),
+            'beds': parser_version(parse_beds_values),
+            'transform': parser_version(transform_df, clean_beds_column, clean_sq_feet_column, clean_pet_column)}
+
+
+class ParseMemos:
+    """
+    The ParseMemo of each parsed column, stored in one JSON file between runs.
+    A memo is emptied when the version of its parser changes.
+    """
+    
+    def __init__(self, path=None):
+        self.path = path or PARSE_MEMO_PATH
+        versions = parser_versions()
+        self.versions = {name: versions[name] for name in ('sq_feet', 'beds')}
+        stored = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    stored = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f'Ignoring unreadable parse memo {self.path}: {e}')
+        self.memos = {}
+        for name, version in self.versions.items():
+            memo = stored.get(name, {})
+            if memo.get('version') != version and memo:
+                logger.info(f'Parser of "{name}" changed, discarding its parse memo')
+            entries = memo.get('entries', []) if memo.get('version') == version else []
+            # JSON turns tuples into lists
+            self.memos[name] = ParseMemo(version, ((raw, tuple(parsed)) for raw, parsed in entries))
+    
+    def __getitem__(self, name):
+        return self.memos[name]
+    
+    def log_stats(self):
+        for name, memo in self.memos.items():
+            logger.debug(f'Parse memo of "{name}": {memo.hits} hits, {memo.misses} misses, {len(memo)} entries')
+    
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({name: {'version': memo.version, 'entries': list(memo.entries.items())}
+                       for name, memo in self.memos.items()}, f)
+        os.replace(tmp_path, self.path)
+
+
+def parse_distinct(parse, uniques, memo=None):
+    """
+    Parse the distinct raw values of a column, consulting the memo for strings parsed before.
+    
+    Parameters:
+    parse (function): Takes an object Series of raw values and returns a DataFrame of parsed values with the same index.
+    uniques (pd.Series): Distinct raw values of a column.
+    memo (ParseMemo): Optional memo of earlier results, updated with the strings parsed now.
+    
+    Returns:
+    pd.DataFrame: The parsed values, in the order of `uniques`.
+    """
+    if memo is None:
+        return parse(uniques)
+    
+    cached = [memo.get(raw) if isinstance(raw, str) else MISSING for raw in uniques]
+    missing = np.fromiter((parsed is MISSING for parsed in cached), dtype=bool, count=len(cached))
+    parsed = parse(uniques[missing])
+    for raw, row in zip(uniques[missing], parsed.itertuples(index=False)):
+        if isinstance(raw, str):
+            memo.put(raw, tuple(None if pd.isna(value) else value.item() if isinstance(value, np.generic) else value for value in row))
+    if not (~missing).any():
+        return parsed
+    
+    hits = pd.DataFrame([row for row in cached if row is not MISSING], index=uniques.index[~missing], columns=parsed.columns)
+    hits = hits.astype({column: dtype for column, dtype in parsed.dtypes.items()})
+    return pd.concat([parsed, hits]).loc[uniques.index]
+
+
+def factorize_column(values):
+    """
+    Codes and distinct values of a column as an object Series; missing values have code -1.
+    """
+    try:
+        codes, uniques = pd.factorize(values)
+    except TypeError:
+        # Unhashable values such as lists, parse every row
+        codes, uniques = np.where(values.isna().to_numpy(), -1, np.arange(len(values))), values.to_numpy()
+    return codes, pd.Series(uniques, dtype=object)
+
 # Function to clean 'beds' column
-def clean_beds(df):
+def parse_beds_values(values):
     """
-    Cleans the 'beds' column in a DataFrame by converting it to integers and adding a 'has_den' boolean column.
+    Converts beds entries to integers and flags the entries with a den.
     
-    This function updates the 'beds' column by converting all entries to integers, with 'studio' and 'None' being treated as 0.
-    A new boolean column 'has_den' is added to indicate whether the original entry included a '+den'.
+    Entries are converted to integers, with 'studio', 'None', 'Not Listed' and empty strings being treated as 0.
+    Anything else which is not a number becomes pd.NA.
     
     Parameters:
-    df (pd.DataFrame): The DataFrame with the 'beds' column to clean.
+    values (pd.Series): Raw beds entries, without missing values.
     
     Returns:
-    pd.DataFrame: The DataFrame with the cleaned 'beds' column and the new 'has_den' column.
+    pd.DataFrame: 'beds' as Int64 and 'has_den' as bool, indicating whether the original entry included a '+den'.
     """
-    # Create 'has_den' column based on the presence of '+den' in the 'beds' column
-    df['has_den'] = df['beds'].astype(str).str.contains('+den', regex=False)
+    text = values.map(str)
+    has_den = text.str.contains('+den', regex=False).astype(bool)
     
-    # Convert all 'beds' values to strings, then replace '+den' with '' and 'studio' with '0'
-    df['beds'] = df['beds'].astype(str).replace({r'\+den': '',
-                                                 'studio': '0',
-                                                 'None': '0',
-                                                 '':'0',
-                                                 'Not Listed':'0'}, regex=True)
+    # Remove '+den' and replace 'studio', 'None' and 'Not Listed' with '0', empty strings are only replaced when they are empty to begin with
+    cleaned = (text.str.replace('+den', '', regex=False)
+                   .str.replace('studio', '0', regex=False)
+                   .str.replace('None', '0', regex=False)
+                   .str.replace('Not Listed', '0', regex=False)
+                   .mask(text.eq(''), '0'))
+    beds = pd.to_numeric(cleaned, errors='coerce', downcast='integer').astype('Int64')  # need a nullable integer dtype
+    return pd.DataFrame({'beds': beds, 'has_den': has_den}, index=values.index)
+
+def clean_beds_column(values, memo=None):
+    """
+    Cleans a column of beds data with parse_beds_values. The column is factorized, so the few distinct values
+    of a snapshot are parsed once, or looked up in the memo, and mapped back to every listing.
     
-    # Convert the 'beds' column to integer
-    df['beds'] = pd.to_numeric(df['beds'], errors='coerce', downcast='integer')
-    df['beds'] = df['beds'].astype('Int64')  # need a nullable integer dtype
+    Parameters:
+    values (pd.Series): The 'beds' column to clean.
+    memo (ParseMemo): Optional memo of values parsed in earlier runs.
+    
+    Returns:
+    tuple: The cleaned 'beds' as an Int64 Series and the boolean 'has_den' Series, both with the index of `values`.
+    """
+    codes, uniques = factorize_column(values)
+    parsed = parse_distinct(parse_beds_values, uniques, memo)
     
-    return df
+    # Missing values have code -1, they become pd.NA and have no den
+    return (pd.Series(parsed['beds'].array.take(codes, allow_fill=True), index=values.index),
+            pd.Series(np.append(parsed['has_den'].to_numpy(dtype=bool), False)[codes], index=values.index))
 
 # Function to clean 'sq_feet column'
 def clean_sq_feet(value)-> int or None:
@@ -248,39 +1330,38 @@ def clean_sq_feet(value)-> int or None:
     else:
         return pd.NA
 
+# Regular expression to find the first number in a square footage string with VERBOSE mode for commenting.
+# Compiled once and shared by the per-value and the vectorized parser.
+SQ_FEET_PATTERN = re.compile(r"""
+    (\d+)            # Match one or more digits (captured)
+    \s*              # Match any whitespace characters (zero or more)
+    (?:              # Non-capturing group for the following:
+        sq           # Match 'sq'
+        (?:uare)?    # Optionally match 'uare' for 'square'
+        \.?          # Optionally match a literal '.' for abbreviation
+        \s*ft        # Match ' ft' with optional space before 'ft'
+        \.?          # Optionally match a literal '.' for abbreviation
+    |                # OR
+        sf           # Match 'sf' for square feet
+    |                # OR
+        ft²          # Match 'ft²' for square feet in square notation
+    |                # OR
+        sqft         # Match 'sqft' for square feet
+    )?               # Make the entire group optional
+    """, re.VERBOSE)
+
 # Function to clean and extract square footage from strings
 def extract_square_feet(value):
-    # Regular expression to find the first number in the string with VERBOSE mode for commenting
-    pattern = re.compile(r"""
-        \d+              # Match one or more digits
-        \s*              # Match any whitespace characters (zero or more)
-        (?:              # Non-capturing group for the following:
-            sq           # Match 'sq'
-            (?:uare)?    # Optionally match 'uare' for 'square'
-            \.?          # Optionally match a literal '.' for abbreviation
-            \s*ft        # Match ' ft' with optional space before 'ft'
-            \.?          # Optionally match a literal '.' for abbreviation
-        |                # OR
-            sf           # Match 'sf' for square feet
-        |                # OR
-            ft²          # Match 'ft²' for square feet in square notation
-        |                # OR
-            sqft         # Match 'sqft' for square feet
-        )?               # Make the entire group optional
-        """, re.VERBOSE)
-
     # Remove commas for consistency
     value = value.lower().replace(',', '')
 
     # Search for the pattern in the cleaned string
-    match = pattern.search(value)
+    match = SQ_FEET_PATTERN.search(value)
     
     if match:
-        # Extract the number and remove any non-numeric characters
-        square_feet = re.sub(r'[^\d]', '', match.group())
         try:
-            # Convert to integer
-            return int(square_feet)
+            # Convert the captured digits to integer
+            return int(match.group(1))
         except ValueError:
             # If conversion fails, return pd.NA
             return pd.NA
@@ -288,202 +1369,347 @@ def extract_square_feet(value):
         # If no number found or if it's a complex description, return pd.NA
         return pd.NA
 
-#Function to clean 'cats' and 'dogs'
-def clean_pet(value):
-    # Check if the value is NaN or 0.0 and return False, else return True
-    return not (pd.isna(value) or value == 0.0)
-
-# Putting all together
-@pa.check_types(lazy=True)
-def transform_df(df_listings: DataFrame[ExtractSchema])-> DataFrame[TransformSchema]:
-    
-    transform_df = clean_beds(df_listings)
-    logger.debug(f'Cleaned "beds" column and added "has_den" column, dtype ={transform_df["beds"].dtype} {transform_df["has_den"].dtype}')
-    
-    transform_df['baths'] = pd.to_numeric(transform_df['baths'].replace('None', pd.NA),errors = 'coerce')
-    logger.debug(f'Cleaned "baths" column, dtype ={transform_df["baths"].dtype}')
-    
-    transform_df['sq_feet'] = transform_df['sq_feet'].apply(clean_sq_feet).astype("Int64")
-    logger.debug(f'Cleaned "sq_feet" column, dtype ={transform_df["sq_feet"].dtype}')
-    
-    transform_df['cats'] = transform_df['cats'].apply(clean_pet)
-    logger.debug(f'Cleaned "cats" column, dtype ={transform_df["cats"].dtype}')
+# Vectorized version of clean_sq_feet for distinct values
+def parse_sq_feet_values(values):
+    """
+    Cleans square feet data with pandas string and numeric array operations.
     
-    transform_df['dogs'] = transform_df['dogs'].apply(clean_pet)
-    logger.debug(f'Cleaned "dogs" column, dtype ={transform_df["dogs"].dtype}')
+    Returns the same values as clean_sq_feet: strings are parsed with SQ_FEET_PATTERN, floats are rounded
+    half to even like `round`, ints and bools are kept and any other value becomes pd.NA.
     
-    transform_df['last_update'] = datetime.now() #.strftime('%Y-%m-%d %H:%M:%S')
-    logger.debug(f'Added "last_update" column, dtype ={transform_df["last_update"].dtype}')
+    Parameters:
+    values (pd.Series): Raw square feet values of dtype object, without missing values.
     
-    transform_df['is_active'] = True    
-    logger.debug(f'Added "is_active" column, dtype ={transform_df["is_active"].dtype}')    
+    Returns:
+    pd.DataFrame: 'sq_feet' as Int64.
+    """
+    parsed = pd.Series(pd.NA, index=values.index, dtype='Int64')
+
+    # Strings: drop thousands separators and capture the first run of digits
+    is_str = values.map(type).eq(str).to_numpy(dtype=bool)
+    if is_str.any():
+        digits = values[is_str].str.replace(',', '', regex=False).str.extract(SQ_FEET_PATTERN, expand=False)
+        numbers = pd.to_numeric(digits, errors='coerce')
+        # \d also matches non-ASCII digits, which int() understands but to_numeric does not
+        exotic = digits.notna() & numbers.isna()
+        if exotic.any():
+            numbers = numbers.astype(object)
+            numbers[exotic] = digits[exotic].map(int)
+        parsed.iloc[np.flatnonzero(is_str)] = numbers.astype('Int64').to_numpy()
+
+    # Other objects: ints (including bools) are kept, floats are rounded, anything else is NA
+    positions = np.flatnonzero(~is_str)
+    if positions.size:
+        others = values.iloc[positions]
+        is_int = others.map(lambda value: isinstance(value, int)).to_numpy(dtype=bool)
+        is_float = others.map(lambda value: isinstance(value, float)).to_numpy(dtype=bool)
+        if is_int.any():
+            parsed.iloc[positions[is_int]] = others[is_int].astype('int64').to_numpy()
+        if is_float.any():
+            parsed.iloc[positions[is_float]] = np.round(others[is_float].to_numpy(dtype='float64'))
+
+    return pd.DataFrame({'sq_feet': parsed})
+
+# Vectorized version of clean_sq_feet for a whole column
+def clean_sq_feet_column(values, memo=None):
+    """
+    Cleans a column of square feet data.
+
+    Returns the same values as `values.apply(clean_sq_feet).astype('Int64')`, see parse_sq_feet_values.
+    Unlike clean_sq_feet, a NaN which is not the `np.nan` object is treated as missing instead of raising.
+    A snapshot repeats a few thousand distinct values over all listings, so the column is factorized
+    and only its distinct values are parsed, or looked up in the memo.
+
+    Parameters:
+    values (pd.Series): The square feet column to clean.
+    memo (ParseMemo): Optional memo of values parsed in earlier runs.
+
+    Returns:
+    pd.Series: The cleaned square feet with dtype Int64 and the index of `values`.
+    """
+    # Numeric columns need no parsing
+    if pd.api.types.is_bool_dtype(values) or pd.api.types.is_integer_dtype(values):
+        return values.astype('Int64')
+    if pd.api.types.is_float_dtype(values):
+        return pd.Series(np.round(values.to_numpy(dtype='float64')), index=values.index).astype('Int64')
+
+    codes, uniques = factorize_column(values)
+    parsed = parse_distinct(parse_sq_feet_values, uniques, memo)
+
+    # Missing values have code -1 and are filled with pd.NA
+    return pd.Series(parsed['sq_feet'].array.take(codes, allow_fill=True), index=values.index)
+
+#Function to clean 'cats' and 'dogs'
+def clean_pet_column(values):
+    # NaN and 0.0 are False, anything else is True
+    return values.notna() & values.ne(0.0)
+
+# Putting all together
+def transform_df(df_listings: DataFrame[ExtractSchema], timings=None, memos=None)-> DataFrame[TransformSchema]:
+    """
+    Cleans the validated listings column by column into a new DataFrame, the input DataFrame is not modified.
+
+    :param df_listings: Listings validated against ExtractSchema.
+    :param timings: Optional dict filled with the seconds spent in each step, keyed by step name.
+    :param memos: Optional ParseMemos consulted before parsing 'beds' and 'sq_feet'.
+    :return: The cleaned listings, with the extracted columns followed by 'has_den', 'last_update', 'is_active' and 'activation_date'.
+    """
+    timings = {} if timings is None else timings
+    columns = {column: df_listings[column] for column in df_listings.columns}
+    start = perf_counter()
+
+    def record(step, *cleaned):
+        nonlocal start
+        timings[step] = perf_counter() - start
+        logger.debug(f'Cleaned {step} in {timings[step]:.4f} seconds, dtype = {" ".join(str(column.dtype) for column in cleaned)}')
+        start = perf_counter()
+
+    columns['beds'], has_den = clean_beds_column(columns['beds'], memo=memos['beds'] if memos is not None else None)
+    columns['beds'] = columns['beds'].where(columns['beds'].between(-128, 127)).astype('Int8') # larger numbers are not a number of bedrooms
+    record('beds', columns['beds'], has_den)
+
+    if not pd.api.types.is_float_dtype(columns['baths']):
+        columns['baths'] = pd.to_numeric(columns['baths'].replace('None', pd.NA), errors='coerce')
+    record('baths', columns['baths'])
+
+    columns['sq_feet'] = clean_sq_feet_column(columns['sq_feet'], memo=memos['sq_feet'] if memos is not None else None)
+    record('sq_feet', columns['sq_feet'])
+
+    columns['cats'] = clean_pet_column(columns['cats'])
+    columns['dogs'] = clean_pet_column(columns['dogs'])
+    record('pets', columns['cats'], columns['dogs'])
+
+    columns['price'] = columns['price'].round().astype(int) #do not cast as "Int64" or it will become a blob
+    record('price', columns['price'])
+
+    # New columns, activation_date is not inserted when updating existing ids.
+    now = datetime.now()
+    columns.update(has_den=has_den, last_update=now, is_active=True, activation_date=now)
+    transformed = pd.DataFrame(columns, index=df_listings.index)
+    record('new columns', transformed['last_update'], transformed['is_active'], transformed['activation_date'])
+
+    logger.debug(f'Transformed {len(transformed)} listings in {sum(timings.values()):.4f} seconds')
+    return transformed
+
+
+def quarantine_listings(df_raw, failure_cases, stage):
+    """
+    Stores the listings which failed validation in the listing_quarantine table, one row per failed check,
+    with the raw listing as fetched attached as JSON.
     
-    transform_df['price'] = transform_df['price'].apply(round).astype(int) #do not cast as "Int64" or it will become a blob
-    logger.debug(f'Cleaned "price" column, dtype ={transform_df["price"].dtype}')    
+    :param df_raw: The DataFrame returned by fetch_data, its index matches the 'index' of the failure cases.
+    :param failure_cases: Failure cases returned by validate_extract or validate_transform.
+    :param stage: Name of the schema the listings failed, 'extract' or 'transform'.
+    :return: The set of quarantined listing ids.
+    """
+    if failure_cases.empty:
+        return set()
     
-    transform_df['activation_date'] = datetime.now() #do not insert this when updating existing ids.
-    logger.debug(f'Added "activation_date" column, dtype ={transform_df["last_update"].dtype}')
+    failed = df_raw.loc[df_raw.index.isin(failure_cases['index'])]
+    # One JSON document per line, in the order of `failed`
+    payloads = dict(zip(failed.index, failed.to_json(orient='records', lines=True).splitlines()))
+    listing_ids = pd.to_numeric(failed['id'], errors='coerce')
+    listing_ids = {index: int(listing_id) for index, listing_id in listing_ids.items() if pd.notna(listing_id)}
+    quarantined_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    values_to_insert = [(listing_ids.get(row.index), #1
+                         stage, #2
+                         row.column, #3
+                         row.check, #4
+                         None if pd.isna(row.failure_case) else str(row.failure_case), #5
+                         payloads.get(row.index), #6
+                         quarantined_at) #7
+                        for row in failure_cases.itertuples(index=False)]
     
-    return transform_df
+    conn = connect('listings')
+    cursor = conn.cursor()
+    try:
+        migrate(conn)
+        cursor.executemany('''
+        INSERT INTO listing_quarantine (
+            listing_id,
+            stage,
+            column_name,
+            failed_check,
+            failure_case,
+            payload,
+            quarantined_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', values_to_insert)
+        conn.commit()
+        logger.warning(f'Quarantined {len(failed)} listings failing {len(values_to_insert)} {stage} checks')
+    except sqlite3.Error as e:
+        logger.exception(f"An error occurred: {e}")
+        conn.rollback()
+    finally:
+        cursor.close()
+        conn.close()
+    return set(listing_ids.values())
+
+
+# Columns of rental_listings in table order. activation_date is only written when a listing is inserted,
+# and a changed last_update alone does not make a listing changed.
+LISTING_COLUMNS = ['id', 'city', 'community', 'latitude', 'longitude', 'link', 'type', 'price', 'beds', 'has_den',
+                   'sq_feet', 'baths', 'cats', 'dogs', 'activation_date', 'last_update', 'is_active']
+UPSERT_COLUMNS = [column for column in LISTING_COLUMNS if column not in ('id', 'activation_date')]
+CHANGE_COLUMNS = [column for column in UPSERT_COLUMNS if column != 'last_update']
+# Columns whose changes are logged in listing_changes, as created in migrations.py
+TRACKED_COLUMNS = ['price', 'beds', 'sq_feet', 'is_active']
+SQL_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 
-def load_to_db(df_listings):
+def sql_column(values):
+    """
+    Converts a column to a list of values sqlite3 can bind: Python scalars, with None for missing values
+    and timestamps as text. Categoricals and timestamps are converted once per distinct value.
+
+    :param values: A column of the transformed DataFrame.
+    :return: A list with one value per row.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_datetime64_any_dtype(values):
+        codes, uniques = pd.factorize(values)
+        if pd.api.types.is_datetime64_any_dtype(uniques):
+            uniques = uniques.strftime(SQL_TIMESTAMP_FORMAT)
+        # Missing values have the code -1, which picks the None appended last
+        return np.append(np.asarray(uniques, dtype=object), None)[codes].tolist()
+    if isinstance(values.dtype, pd.api.extensions.ExtensionDtype):
+        missing = values.isna().to_numpy()
+        if pd.api.types.is_integer_dtype(values):
+            converted = values.to_numpy(dtype='int64', na_value=0).astype(object) # int() to avoid the data being a BLOB
+        else:
+            converted = values.to_numpy(dtype=object)
+        converted[missing] = None
+        return converted.tolist()
+    converted = values.to_numpy()
+    if converted.dtype.kind == 'f' and np.isnan(converted).any():
+        missing = np.isnan(converted)
+        converted = converted.astype(object)
+        converted[missing] = None
+    return converted.tolist()
+
+
+def load_to_db(df_listings, skip_communities=(), keep_ids=(), deactivate=True):
     """
     Loads the transformed DataFrame of listings into a SQLite database,
-    updating existing records and inserting new ones.
+    inserting new records and updating the existing ones whose content changed.
+    The listings are staged in a temporary table and merged with a single upsert.
+    New listings, changes of TRACKED_COLUMNS and deactivations are appended to listing_changes,
+    and new listings are queued for the spatial join stages. The mappings of listings whose coordinates
+    changed are deleted and the listings are queued again.
     
-    :param df_listings: The DataFrame containing transformed rental listings.
+    :param df_listings: The DataFrame containing transformed rental listings. When it is empty, e.g. no listing changed
+                        since the last run, only the listings which went offline are deactivated.
+    :param skip_communities: Communities which could not be fetched. Their listings are not deactivated.
+    :param keep_ids: Ids of listings which are still online but unchanged, so they are neither updated nor deactivated.
+    :param deactivate: Whether listings missing from the incoming data are deactivated. False when the fetch was incomplete.
+    :return: True if the transaction was committed, False if it was rolled back.
     """
-    
-    # Save the final DataFrame to a CSV file for debugging
-    df_listings.to_csv('listing_df_cleaned_validated.csv')
        
-    # Connect to the SQLite database
-    conn = sqlite3.connect('database.db')
+    # Connect to the SQLite database with the shared settings, see db.py
+    conn = connect('listings')
     cursor = conn.cursor()
 
-    # Drop table if exists for testing
-    #cursor.execute('''DROP TABLE IF EXISTS rental_listings''')
-    #logger.warning('Dropped Table for testing.')
-    
-    # Create table if not exists
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS rental_listings (
-        id INTEGER PRIMARY KEY,
-        city TEXT NOT NULL,
-        community TEXT NOT NULL,
-        latitude REAL NOT NULL,
-        longitude REAL NOT NULL,
-        link TEXT NOT NULL,
-        type TEXT NOT NULL,
-        price INTEGER NOT NULL,
-        beds INTEGER,
-        has_den INTEGER,
-        sq_feet INTEGER NULL,
-        baths REAL,
-        cats INTEGER,
-        dogs INTEGER,
-        activation_date TEXT NOT NULL,
-        last_update TEXT NOT NULL,
-        is_active INTEGER NOT NULL
-    )
-    ''')
+    # Create or upgrade the tables and indexes, see migrations.py
+    migrate(conn)
     
     
     # Begin transaction
     try:
-        # Get all existing 'id' from the table regardless of the is_active flag
-        cursor.execute("SELECT DISTINCT(id) FROM rental_listings")
-        existing_ids = {row[0] for row in cursor.fetchall()} #a set
-        logger.debug(f'Retrieved {len(existing_ids)} existing_ids')
-
-        # Filter the DataFrame
-        df_update = df_listings[df_listings['id'].isin(existing_ids)]
-        df_insert = df_listings[~df_listings['id'].isin(existing_ids)].copy()
-        logger.debug(f'Number of existing rows to be updated: {len(df_update)}')
-        logger.debug(f'Number of new rows to be updated: {len(df_insert)}')
-        
+        # Stage the incoming listings in one bulk insert, the upsert below is a single statement
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS staging_listings AS SELECT * FROM rental_listings WHERE 0')
+        cursor.execute('DELETE FROM staging_listings')
+        if not df_listings.empty:
+            rows = zip(*[sql_column(df_listings[column]) for column in LISTING_COLUMNS])
+            cursor.executemany(f"INSERT INTO staging_listings ({', '.join(LISTING_COLUMNS)}) VALUES ({', '.join('?' * len(LISTING_COLUMNS))})", rows)
+        logger.debug(f'Staged {len(df_listings)} incoming listings')
         
-        # Update is_active to False for all existing active records that are not in the incoming data
-        inactive_ids = existing_ids - set(df_listings['id'].unique())
-        cursor.executemany("UPDATE rental_listings SET is_active = ?, last_update = ? WHERE is_active = True AND id = ? ", 
-                           [(False, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), id) for id in inactive_ids])
-        logger.info(f'Deactivated {cursor.rowcount} listings not present in incoming data')
         
-        # Update existing records
-        values_to_update = [(row.city, #1
-                             row.community, #2
-                             row.latitude, #3
-                             row.longitude, #4
-                             row.link, #5
-                             row.type,  #6
-                             row.price, #7
-                             None if pd.isna(row.beds) else int(row.beds), #8
-                             row.has_den, #9
-                             None if pd.isna(row.sq_feet) else int(row.sq_feet), #10
-                             None if pd.isna(row.baths) else float(row.baths), #11
-                             row.cats,#12
-                             row.dogs, #13
-                             row.last_update.strftime('%Y-%m-%d %H:%M:%S'), #14 , be sure to skip 'activation_date' here
-                             row.is_active, #15
-                             row.id) #16
-                            for row in df_update.itertuples(index=False)]
+        # Update is_active to False for all existing active records that are not in the incoming data,
+        # except those of communities that failed to fetch. The partial index keeps this proportional to
+        # the active listings however many inactive listings the table holds.
+        if deactivate:
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS staging_kept_ids (id INTEGER PRIMARY KEY)')
+            cursor.execute('DELETE FROM staging_kept_ids')
+            cursor.executemany('INSERT OR IGNORE INTO staging_kept_ids (id) VALUES (?)', ((int(id),) for id in keep_ids))
+            skipped = f"AND community NOT IN ({','.join('?' * len(skip_communities))})" if skip_communities else ''
+            vanished = f'''is_active = 1
+                AND id NOT IN (SELECT id FROM staging_listings)
+                AND id NOT IN (SELECT id FROM staging_kept_ids)
+                {skipped}'''
+            # The listings to deactivate are found once, then logged and deactivated
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS staging_vanished_ids (id INTEGER PRIMARY KEY)')
+            cursor.execute('DELETE FROM staging_vanished_ids')
+            cursor.execute(f'INSERT INTO staging_vanished_ids (id) SELECT id FROM rental_listings WHERE {vanished}', list(skip_communities))
+            now = datetime.now().strftime(SQL_TIMESTAMP_FORMAT)
+            cursor.execute(f'''
+            INSERT INTO listing_changes (listing_id, changed_at, change_type, {', '.join(TRACKED_COLUMNS)})
+            SELECT id, ?, 'delisted', {', '.join(column if column != 'is_active' else '0' for column in TRACKED_COLUMNS)}
+            FROM rental_listings WHERE id IN (SELECT id FROM staging_vanished_ids)
+            ''', [now])
+            cursor.execute('UPDATE rental_listings SET is_active = 0, last_update = ? WHERE id IN (SELECT id FROM staging_vanished_ids)', [now])
+            logger.info(f'Deactivated {cursor.rowcount} listings not present in incoming data')
+            if skip_communities:
+                cursor.execute(f"SELECT COUNT(*) FROM rental_listings WHERE is_active = 1 AND community IN ({','.join('?' * len(skip_communities))})",
+                               list(skip_communities))
+                logger.warning(f'Kept {cursor.fetchone()[0]} active listings of {len(skip_communities)} communities that failed to fetch')
+            cursor.execute('DELETE FROM staging_kept_ids')
+            cursor.execute('DELETE FROM staging_vanished_ids')
         
-        update_query = '''
-        UPDATE rental_listings SET
-            city = ?,
-            community = ?,
-            latitude = ?,
-            longitude = ?,
-            link = ?,
-            type = ?,
-            price = ?,
-            beds = ?,
-            has_den = ?,
-            sq_feet = ?,
-            baths = ?,
-            cats = ?,
-            dogs = ?,
-            last_update = ?,
-            is_active = ?
-        WHERE id = ?
-        '''
-        cursor.executemany(update_query, values_to_update)
-        logger.info(f'Finished updating {len(values_to_update)} existing records')
-                
-        values_to_insert = [(
-            row.id, #1
-            row.city, #2
-            row.community, #3
-            row.latitude, #4
-            row.longitude, #5
-            row.link, #6
-            row.type, #7
-            row.price, #8
-            None if pd.isna(row.beds) else int(row.beds), #9 handle pd.NA values as None
-            row.has_den, #10
-            None if pd.isna(row.sq_feet) else int(row.sq_feet), #11 handle pd.NA values as None, use int() to avoid the data being a BLOB
-            None if pd.isna(row.baths) else float(row.baths), #12 handle pd.NA values as None
-            row.cats, #13
-            row.dogs,#14
-            row.activation_date.strftime('%Y-%m-%d %H:%M:%S'), #15 convert datetime to string
-            row.last_update.strftime('%Y-%m-%d %H:%M:%S'), #16 convert datetime to string
-            row.is_active #17
-            ) for row in df_insert.itertuples(index= False)]
+        # Listings whose pin moved lose their mappings and wait for the spatial joins again, see mapping_state.py
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS staging_moved_ids (id INTEGER PRIMARY KEY)')
+        cursor.execute('DELETE FROM staging_moved_ids')
+        cursor.execute(f'''
+        INSERT INTO staging_moved_ids (id)
+        SELECT s.id FROM staging_listings s INNER JOIN rental_listings r ON r.id = s.id
+        WHERE {coordinates_moved('r', 's')}
+        ''')
+        moved = cursor.rowcount
+        if moved:
+            deleted = invalidate(conn, 'SELECT id FROM staging_moved_ids')
+            logger.info(f'Deleted {deleted} mappings of {moved} listings whose coordinates changed, they will be mapped again')
+        cursor.execute('DELETE FROM staging_moved_ids')
         
-        insert_query = '''
-        INSERT INTO rental_listings (
-            id,
-            city,
-            community,
-            latitude,
-            longitude,
-            link,
-            type,
-            price,
-            beds,
-            has_den,
-            sq_feet,
-            baths,
-            cats,
-            dogs,
-            activation_date,
-            last_update,
-            is_active
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        '''
-        
-        cursor.executemany(insert_query, values_to_insert)
-        logger.info(f'Finished inserting {len(values_to_insert)} new records')
+        cursor.execute('SELECT COALESCE(MAX(change_id), 0) FROM listing_changes')
+        last_change_id = cursor.fetchone()[0]
+        # Log new listings and changes of the tracked columns before the upsert overwrites them
+        cursor.execute(f'''
+        INSERT INTO listing_changes (listing_id, changed_at, change_type, {', '.join(TRACKED_COLUMNS)})
+        SELECT s.id, s.last_update,
+            CASE WHEN r.id IS NULL THEN 'listed' WHEN r.is_active IS NOT s.is_active THEN 'relisted' ELSE 'changed' END,
+            {', '.join(f's.{column}' for column in TRACKED_COLUMNS)}
+        FROM staging_listings s LEFT JOIN rental_listings r ON r.id = s.id
+        WHERE r.id IS NULL OR {' OR '.join(f'r.{column} IS NOT s.{column}' for column in TRACKED_COLUMNS)}
+        ''')
+        logger.debug(f'Logged {cursor.rowcount} new or changed listings in listing_changes')
+        cursor.execute("SELECT COUNT(*) FROM listing_changes WHERE change_id > ? AND change_type = 'listed'", [last_change_id])
+        inserted = cursor.fetchone()[0]
+        # Insert new listings and update existing ones whose content changed, be sure to skip 'activation_date' here.
+        # 'WHERE true' lets SQLite tell the ON CONFLICT clause of the upsert from a join constraint of the SELECT.
+        cursor.execute(f'''
+        INSERT INTO rental_listings ({', '.join(LISTING_COLUMNS)})
+        SELECT {', '.join(LISTING_COLUMNS)} FROM staging_listings WHERE true
+        ON CONFLICT(id) DO UPDATE SET
+            {', '.join(f'{column} = excluded.{column}' for column in UPSERT_COLUMNS)}
+        WHERE {' OR '.join(f'rental_listings.{column} IS NOT excluded.{column}' for column in CHANGE_COLUMNS)}
+        ''')
+        logger.info(f'Finished inserting {inserted} new records')
+        logger.info(f'Finished updating {cursor.rowcount - inserted} changed records, '
+                    f'{len(df_listings) - cursor.rowcount} incoming records are unchanged')
+        # Queue the new listings for the spatial join stages, see mapping_state.py
+        queued = enqueue(conn, 'SELECT id FROM staging_listings')
+        logger.debug(f'Queued {queued} listings for the spatial join stages')
+        cursor.execute('DELETE FROM staging_listings')
 
         # Commit if no errors
         conn.commit()
         logger.debug(f'COMMIT')
+        analyze(conn)
+        return True
     except sqlite3.Error as e:
         # Rollback on any error
         logger.exception(f"An error occurred: {e}")
         conn.rollback()
         logger.debug(f'ROLLBACK')
+        return False
     finally:
         # Close the cursor and connection
         
@@ -507,15 +1733,48 @@ def main():
     #nest_asyncio.apply()
     
     try:
-        df_listings = asyncio.run(fetch_data())
+        report = FetchReport()
+        df_raw = asyncio.run(fetch_data(report))
+        log_memory_usage(df_raw, 'Fetched listings')
+        # Archive the listings as fetched for debugging, and the active listings once loaded for trend analysis
+        run_time = datetime.now()
+        write_snapshot(df_raw, 'raw', run_time)
+        validation = ValidationCache() if VALIDATION_MODE == 'incremental' else None
+        # Invalid listings are quarantined and the valid ones loaded
+        df_listings, failure_cases = validate_extract(df_raw, validation)
+        quarantined_ids = quarantine_listings(df_raw, failure_cases, 'extract')
         logger.info(f'Total number of validated listings: {df_listings.shape[0]}')
-        df_listings = transform_df(df_listings)
-        load_to_db(df_listings)
+        if not df_listings.empty:
+            memos = ParseMemos() if USE_PARSE_MEMO else None
+            df_listings, failure_cases = validate_transform(transform_df(df_listings, memos=memos), validation)
+            log_memory_usage(df_listings, 'Transformed listings')
+            if memos is not None:
+                memos.log_stats()
+                memos.save()
+            quarantined_ids |= quarantine_listings(df_raw, failure_cases, 'transform')
+        else:
+            logger.info('No changed listings to load, only deactivating the listings which went offline')
+        if not report.complete:
+            logger.warning('Some tiles failed to fetch, listings will not be deactivated in this run')
+        # Deactivation runs even without changed listings, so communities whose listings all went offline are
+        # cleared before their fingerprints are saved. Quarantined listings are still online, keep their last valid version active
+        loaded = load_to_db(df_listings, skip_communities=report.failed_communities, keep_ids=report.unchanged_ids | quarantined_ids,
+                            deactivate=report.complete)
+        # Only remember the fingerprints once the listings behind them are in the database
+        if loaded and report.cache is not None:
+            report.cache.save()
+        if loaded and validation is not None:
+            validation.save(keep_ids=report.unchanged_ids)
+        if loaded:
+            # The fetched listings only hold the changes of the run, the database holds the whole market
+            conn = connect('snapshot')
+            try:
+                write_active_snapshot(conn, run_time)
+            finally:
+                conn.close()
     except pa.errors.SchemaErrors as err:
-        #logger.exception("Schema errors and failure cases:")
-        #logger.exception(err.failure_cases)
-        logger.exception("\nSaving DataFrame object that failed validation to csv")
-        err.data.to_csv(f'log/listing_df_error_{datetime.now().strftime("%Y_%m_%d")}.csv')  
+        # Failures not tied to a listing, e.g. a missing column, so nothing is loaded
+        logger.exception("\nSaving failure cases of the DataFrame which failed validation to csv")
         err.failure_cases.to_csv(f'log/listing_df_failure_cases_{datetime.now().strftime("%Y_%m_%d")}.csv')
     
     #End timer
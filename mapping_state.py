@@ -0,0 +1,133 @@
+"""
+Queue of the listings to map by the spatial join stages.
+
+`listing_mapping_state` holds one row per listing and stage, 'pending' until the stage has processed the
+listing and 'done' afterwards, with the number of mappings it created (0 when the listing is in no zone).
+load_listing queues the listings it loads for every stage, and each stage reads its pending listings through
+a partial index holding only the pending rows, so finding the work of a run does not depend on the size of
+the listing and mapping tables, and listings which matched no zone are not checked again on every run.
+"""
+from datetime import datetime
+from itertools import repeat
+from time import perf_counter
+import pandas as pd
+from loguru import logger
+
+# Spatial join stages tracked in listing_mapping_state, with the mapping table each one fills
+MAPPING_STAGES = {
+    'crime': 'listing_with_crime',
+    'attendance_area': 'schools_within_attendance_area',
+    'walk_zone': 'schools_within_walk_zone',
+}
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+COORDINATE_DECIMALS = 5 # coordinates are compared on a grid of about 1 m, so jitter of the pins does not remap them
+
+
+def enqueue(conn, source, parameters=(), stages=MAPPING_STAGES):
+    """
+    Queue listings for the spatial join stages which have not seen them yet. Listings already queued or
+    processed by a stage are left as they are.
+
+    :param conn: A connection to the database. The caller commits.
+    :param source: A SELECT statement returning the listing ids as its only column, e.g. 'SELECT id FROM staging_listings'.
+    :param parameters: Parameters of `source`.
+    :param stages: Stages to queue the listings for.
+    :return: The number of rows queued.
+    """
+    queued = 0
+    for stage in stages:
+        # 'WHERE true' lets SQLite tell the ON CONFLICT clause from a join constraint of the SELECT
+        cursor = conn.execute(f'''
+            INSERT INTO listing_mapping_state (listing_id, stage, status)
+            SELECT *, ?, 'pending' FROM ({source}) WHERE true
+            ON CONFLICT(listing_id, stage) DO NOTHING
+            ''', [stage, *parameters])
+        queued += cursor.rowcount
+    return queued
+
+
+def coordinates_moved(old, new, decimals=COORDINATE_DECIMALS):
+    """
+    SQL condition telling whether the quantized coordinates of two aliases of listing rows differ.
+
+    :param old: Alias of the stored listing, e.g. 'r'.
+    :param new: Alias of the incoming listing, e.g. 's'.
+    :param decimals: Decimals of the coordinates compared.
+    :return: A SQL expression.
+    """
+    scale = f'1e{int(decimals)}'
+    return ' OR '.join(f'ROUND({old}.{column} * {scale}) IS NOT ROUND({new}.{column} * {scale})' for column in ['latitude', 'longitude'])
+
+
+def invalidate(conn, source, parameters=(), stages=MAPPING_STAGES):
+    """
+    Delete the mappings of listings from the tables of the spatial join stages and queue the listings again,
+    e.g. after their coordinates changed.
+
+    :param conn: A connection to the database. The caller commits.
+    :param source: A SELECT statement returning the listing ids as its only column, e.g. 'SELECT id FROM staging_moved_ids'.
+    :param parameters: Parameters of `source`.
+    :param stages: Stages whose mappings are invalidated.
+    :return: The number of mappings deleted.
+    """
+    deleted = 0
+    for stage in stages:
+        deleted += conn.execute(f'DELETE FROM {MAPPING_STAGES[stage]} WHERE listing_id IN ({source})', list(parameters)).rowcount
+    placeholders = ', '.join('?' * len(stages))
+    conn.execute(f'''UPDATE listing_mapping_state SET status = 'pending', matches = NULL, processed_at = NULL
+                     WHERE listing_id IN ({source}) AND stage IN ({placeholders})''', [*parameters, *stages])
+    enqueue(conn, source, parameters, stages)
+    return deleted
+
+
+def pending_listings(conn, stage):
+    """
+    Read the coordinates of the listings waiting for a stage.
+
+    :param conn: A connection to the database.
+    :param stage: One of MAPPING_STAGES.
+    :return: A DataFrame with 'id', 'latitude' and 'longitude'.
+    """
+    start = perf_counter()
+    df = pd.read_sql_query('''
+                           SELECT r.id, r.latitude, r.longitude
+                           FROM listing_mapping_state m
+                           INNER JOIN rental_listings r ON r.id = m.listing_id
+                           WHERE m.stage = ? AND m.status = 'pending'
+                           ''', conn, params=[stage])
+    logger.debug(f'Found {len(df)} listings waiting for {stage} in {perf_counter() - start:.4f} seconds')
+    return df
+
+
+def mark_processed(conn, stage, listing_ids, mapped_ids):
+    """
+    Mark listings as processed by a stage, with the number of mappings created for each of them.
+
+    :param conn: A connection to the database, in the transaction which inserted the mappings. The caller commits.
+    :param stage: One of MAPPING_STAGES.
+    :param listing_ids: Ids of the listings the stage processed.
+    :param mapped_ids: Listing id of each mapping created, a listing in several zones appears several times.
+    """
+    listing_ids = pd.Series(listing_ids, dtype='int64')
+    matches = pd.Series(mapped_ids, dtype='int64').value_counts().reindex(listing_ids, fill_value=0)
+    now = datetime.now().strftime(TIMESTAMP_FORMAT)
+    records = zip(matches.tolist(), repeat(now), listing_ids.tolist(), repeat(stage))
+    conn.executemany('''UPDATE listing_mapping_state SET status = 'done', matches = ?, processed_at = ?
+                        WHERE listing_id = ? AND stage = ?''', records)
+
+
+def recount_matches(conn, stage, listing_ids):
+    """
+    Count again the mappings of processed listings after some of their mappings were replaced.
+
+    :param conn: A connection to the database. The caller commits.
+    :param stage: One of MAPPING_STAGES.
+    :param listing_ids: Ids of the listings whose mappings changed.
+    """
+    now = datetime.now().strftime(TIMESTAMP_FORMAT)
+    conn.executemany(f'''UPDATE listing_mapping_state
+                         SET matches = (SELECT COUNT(*) FROM {MAPPING_STAGES[stage]} t WHERE t.listing_id = listing_mapping_state.listing_id),
+                             processed_at = ?
+                         WHERE listing_id = ? AND stage = ? AND status = 'done'
+                      ''',
+                     zip(repeat(now), pd.Series(listing_ids, dtype='int64').tolist(), repeat(stage)))
@@ -0,0 +1,389 @@
+"""
+Schema of database.db, upgraded by versioned migrations.
+
+The version of a database is stored in `PRAGMA user_version`. `migrate` applies the migrations above it in
+order, each one in its own transaction together with the new version number, so a database is never left
+half-migrated. Tables are created with IF NOT EXISTS, which lets the first migration adopt databases created
+before the migrations existed.
+
+`analyze` refreshes the statistics used by the query planner after a load, and `check_query_plans` flags
+full table scans in the report queries of `sql views`. Run this module to migrate database.db and check
+the report queries:
+
+    python migrations.py
+"""
+import argparse
+import glob
+import os
+import sqlite3
+import sys
+from time import perf_counter
+from loguru import logger
+from db import connect
+
+REPORT_QUERY_DIR = 'sql views'
+ANALYSIS_LIMIT = 1000 # rows sampled per index by ANALYZE, 0 for all rows
+
+# version -> (description, statements)
+MIGRATIONS = {
+    1: ('Tables of the pipeline', [
+        '''
+        CREATE TABLE IF NOT EXISTS rental_listings (
+            id INTEGER PRIMARY KEY,
+            city TEXT NOT NULL,
+            community TEXT NOT NULL,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            link TEXT NOT NULL,
+            type TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            beds INTEGER,
+            has_den INTEGER,
+            sq_feet INTEGER NULL,
+            baths REAL,
+            cats INTEGER,
+            dogs INTEGER,
+            activation_date TEXT NOT NULL,
+            last_update TEXT NOT NULL,
+            is_active INTEGER NOT NULL
+        )
+        ''',
+        # Active listings only, used to find the listings to deactivate
+        'CREATE INDEX IF NOT EXISTS idx_rental_listings_active ON rental_listings (id) WHERE is_active = 1',
+        # Finds the listings of a community to read their history
+        'CREATE INDEX IF NOT EXISTS idx_rental_listings_community ON rental_listings (community)',
+        '''
+        CREATE TABLE IF NOT EXISTS listing_quarantine (
+            quarantine_id INTEGER PRIMARY KEY,
+            listing_id INTEGER,
+            stage TEXT NOT NULL,
+            column_name TEXT,
+            failed_check TEXT NOT NULL,
+            failure_case TEXT,
+            payload TEXT,
+            quarantined_at TEXT NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_listing_quarantine_listing_id ON listing_quarantine (listing_id, quarantined_at)',
+        'CREATE INDEX IF NOT EXISTS idx_listing_quarantine_quarantined_at ON listing_quarantine (quarantined_at)',
+        # Append-only log of the tracked columns of each listing, one row each time one of them changes.
+        # The index covers all the columns, so the history of a listing is read from the index alone.
+        '''
+        CREATE TABLE IF NOT EXISTS listing_changes (
+            change_id INTEGER PRIMARY KEY,
+            listing_id INTEGER NOT NULL,
+            changed_at TEXT NOT NULL,
+            change_type TEXT NOT NULL,
+            price INTEGER,
+            beds INTEGER,
+            sq_feet INTEGER,
+            is_active INTEGER NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_listing_changes_listing_id ON listing_changes (listing_id, changed_at, change_type, price, beds, sq_feet, is_active)',
+        # Listings loaded before the log existed start from their current state
+        '''
+        INSERT INTO listing_changes (listing_id, changed_at, change_type, price, beds, sq_feet, is_active)
+        SELECT id, last_update, 'baseline', price, beds, sq_feet, is_active FROM rental_listings
+        WHERE NOT EXISTS (SELECT 1 FROM listing_changes)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS schools (
+            school_id INTEGER PRIMARY KEY,
+            name TEXT,
+            address TEXT,
+            phone TEXT,
+            fax TEXT,
+            email TEXT,
+            website TEXT,
+            school_hour TEXT,
+            grades TEXT,
+            ward TEXT,
+            area TEXT,
+            total_enrolment INTEGER,
+            programs_list TEXT,
+            desc TEXT,
+            kindergarten_enrolment INTEGER,
+            grade_1_enrolment INTEGER,
+            grade_2_enrolment INTEGER,
+            grade_3_enrolment INTEGER,
+            grade_4_enrolment INTEGER,
+            grade_5_enrolment INTEGER,
+            grade_6_enrolment INTEGER,
+            grade_7_enrolment INTEGER,
+            grade_8_enrolment INTEGER,
+            grade_9_enrolment INTEGER,
+            grade_10_enrolment INTEGER,
+            grade_11_enrolment INTEGER,
+            grade_12_enrolment INTEGER
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS attendance_areas (
+            attendance_area_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            school_id INTEGER,
+            polygon_number INTEGER,
+            long_coordinate REAL,
+            lat_coordinate REAL,
+            FOREIGN KEY(school_id) REFERENCES schools(school_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS walk_zones (
+            walk_zone_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            school_id INTEGER,
+            polygon_number INTEGER,
+            long_coordinate REAL,
+            lat_coordinate REAL,
+            FOREIGN KEY(school_id) REFERENCES schools(school_id)
+        )
+        ''',
+        # Filled by clean_school_ranking/rank_insertion.ipynb
+        '''
+        CREATE TABLE IF NOT EXISTS school_ranking (
+            id INTEGER PRIMARY KEY,
+            school_name TEXT,
+            rank_detail_url TEXT,
+            school_rating REAL,
+            school_rank TEXT,
+            city TEXT,
+            school_group TEXT,
+            school_type TEXT,
+            school_id INTEGER,
+            FOREIGN KEY(school_id) REFERENCES schools(school_id)
+        )
+        ''',
+        # Filled by lottery/load_lottery.ipynb
+        '''
+        CREATE TABLE IF NOT EXISTS school_lottery (
+            id INTEGER PRIMARY KEY,
+            school_id INTEGER,
+            school_year TEXT,
+            remarks TEXT,
+            FOREIGN KEY(school_id) REFERENCES schools(school_id)
+        )
+        ''',
+        # Filled by crime_rate/crime.ipynb
+        '''
+        CREATE TABLE IF NOT EXISTS crime (
+            id INTEGER PRIMARY KEY,
+            sector TEXT,
+            community TEXT,
+            crime_count REAL,
+            crime_pct REAL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS listing_with_crime (
+            id INTEGER PRIMARY KEY,
+            listing_id INTEGER,
+            crime_id INTEGER,
+            FOREIGN KEY(listing_id) REFERENCES rental_listings (id),
+            FOREIGN KEY(crime_id) REFERENCES crime(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS schools_within_attendance_area (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            listing_id INTEGER,
+            school_id INTEGER,
+            FOREIGN KEY(listing_id) REFERENCES rental_listings(id),
+            FOREIGN KEY(school_id) REFERENCES schools(school_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS schools_within_walk_zone (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            listing_id INTEGER,
+            school_id INTEGER,
+            FOREIGN KEY(listing_id) REFERENCES rental_listings(id),
+            FOREIGN KEY(school_id) REFERENCES schools(school_id)
+        )
+        ''',
+        # Tables of the first version of the listings scraper (Listing_db), still read by sql views/view1.sql
+        '''
+        CREATE TABLE IF NOT EXISTS schools_within_catchment (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            listing_id INTEGER,
+            school_id INTEGER,
+            FOREIGN KEY(listing_id) REFERENCES rental_listings(id),
+            FOREIGN KEY(school_id) REFERENCES schools(school_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS price_history (
+            id INTEGER PRIMARY KEY,
+            listing_id INTEGER,
+            price REAL,
+            date TIMESTAMP,
+            FOREIGN KEY (listing_id) REFERENCES rental_listings (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS utilities_included (
+            id INTEGER PRIMARY KEY,
+            listing_id INTEGER,
+            utility TEXT,
+            FOREIGN KEY (listing_id) REFERENCES rental_listings (id)
+        )
+        ''',
+    ]),
+    2: ('Indexes of the joins and filters of the report queries and the spatial joins', [
+        'CREATE INDEX IF NOT EXISTS idx_rental_listings_is_active_price ON rental_listings (is_active, price)',
+        'CREATE INDEX IF NOT EXISTS idx_listing_with_crime_listing_id ON listing_with_crime (listing_id, crime_id)',
+        'CREATE INDEX IF NOT EXISTS idx_schools_within_walk_zone_listing_id ON schools_within_walk_zone (listing_id, school_id)',
+        'CREATE INDEX IF NOT EXISTS idx_schools_within_attendance_area_listing_id ON schools_within_attendance_area (listing_id, school_id)',
+        'CREATE INDEX IF NOT EXISTS idx_schools_within_catchment_listing_id ON schools_within_catchment (listing_id, school_id)',
+        'CREATE INDEX IF NOT EXISTS idx_school_ranking_school_id ON school_ranking (school_id)',
+        'CREATE INDEX IF NOT EXISTS idx_school_lottery_school_id ON school_lottery (school_id)',
+        'CREATE INDEX IF NOT EXISTS idx_attendance_areas_school_id ON attendance_areas (school_id)',
+        'CREATE INDEX IF NOT EXISTS idx_walk_zones_school_id ON walk_zones (school_id)',
+    ]),
+    3: ('Queue of the listings to map by the spatial join stages, see mapping_state.py', [
+        '''
+        CREATE TABLE IF NOT EXISTS listing_mapping_state (
+            listing_id INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            status TEXT NOT NULL, -- 'pending' or 'done'
+            matches INTEGER, -- mappings created by the stage, 0 if the listing is in no zone
+            processed_at TEXT,
+            PRIMARY KEY (listing_id, stage),
+            FOREIGN KEY (listing_id) REFERENCES rental_listings (id)
+        ) WITHOUT ROWID
+        ''',
+        # Only the pending rows, read by each stage to find its work
+        "CREATE INDEX IF NOT EXISTS idx_listing_mapping_state_pending ON listing_mapping_state (stage, listing_id) WHERE status = 'pending'",
+        # Listings with mappings are done, the others are checked once more as they may never have been processed
+        *[f'''
+        INSERT OR IGNORE INTO listing_mapping_state (listing_id, stage, status, matches, processed_at)
+        SELECT r.id, '{stage}', IIF(m.matches IS NULL, 'pending', 'done'), m.matches, IIF(m.matches IS NULL, NULL, r.last_update)
+        FROM rental_listings r
+        LEFT JOIN (SELECT listing_id, COUNT(*) AS matches FROM {table} GROUP BY listing_id) m ON m.listing_id = r.id
+        ''' for stage, table in [('crime', 'listing_with_crime'),
+                                 ('attendance_area', 'schools_within_attendance_area'),
+                                 ('walk_zone', 'schools_within_walk_zone')]],
+    ]),
+    4: ('Versions of the school zones, to remap only the listings around the zones which changed', [
+        '''
+        CREATE TABLE IF NOT EXISTS zone_versions (
+            zone_type TEXT NOT NULL, -- 'attendance_area' or 'walk_zone'
+            school_id INTEGER NOT NULL,
+            geometry_hash TEXT NOT NULL,
+            min_longitude REAL NOT NULL,
+            min_latitude REAL NOT NULL,
+            max_longitude REAL NOT NULL,
+            max_latitude REAL NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (zone_type, school_id)
+        ) WITHOUT ROWID
+        ''',
+        # Finds the listings within the bounding box of a zone
+        'CREATE INDEX IF NOT EXISTS idx_rental_listings_location ON rental_listings (longitude, latitude)',
+        # Deletes the mappings of a school
+        'CREATE INDEX IF NOT EXISTS idx_schools_within_attendance_area_school_id ON schools_within_attendance_area (school_id)',
+        'CREATE INDEX IF NOT EXISTS idx_schools_within_walk_zone_school_id ON schools_within_walk_zone (school_id)',
+    ]),
+}
+LATEST_VERSION = max(MIGRATIONS)
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, target=LATEST_VERSION):
+    """
+    Apply the migrations between the version of the database and `target`.
+
+    :param conn: A connection to the database.
+    :param target: Version to migrate to, the latest by default.
+    :return: The version of the database after the migrations.
+    """
+    version = schema_version(conn)
+    if version > LATEST_VERSION:
+        raise RuntimeError(f'database.db has schema version {version}, newer than the latest migration {LATEST_VERSION}')
+    for number in range(version + 1, target + 1):
+        description, statements = MIGRATIONS[number]
+        start = perf_counter()
+        # DDL does not open a transaction implicitly in sqlite3, so the migration opens it
+        conn.commit()
+        conn.execute('BEGIN')
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            logger.exception(f'Migration {number} ({description}) failed, database.db stays at version {number - 1}')
+            raise
+        logger.info(f'Migrated database.db to version {number}: {description} in {perf_counter() - start:.2f} seconds')
+        version = number
+    return version
+
+
+def analyze(conn, limit=ANALYSIS_LIMIT):
+    """
+    Refresh the statistics of the tables and indexes used by the query planner. With a limit, ANALYZE samples
+    the indexes instead of reading them in full, so its cost does not grow with the tables.
+
+    :param conn: A connection to the database, with no open transaction.
+    :param limit: Rows sampled per index, 0 for all rows.
+    """
+    start = perf_counter()
+    conn.execute(f'PRAGMA analysis_limit = {int(limit)}')
+    conn.execute('ANALYZE')
+    conn.commit()
+    logger.debug(f'Analyzed database.db in {perf_counter() - start:.2f} seconds')
+
+
+def concat(*values):
+    return ''.join(str(value) for value in values if value is not None)
+
+
+def check_query_plans(conn, paths=None):
+    """
+    Explain the report queries and flag full scans of tables, i.e. plan steps scanning a table without an index
+    or building an automatic index.
+
+    :param conn: A connection to the database.
+    :param paths: SQL files to check, the files of REPORT_QUERY_DIR by default.
+    :return: A dict of path -> list of plan steps which are full scans, empty lists for clean queries.
+    """
+    if sqlite3.sqlite_version_info < (3, 44):
+        # The report queries use CONCAT, built into SQLite from 3.44
+        conn.create_function('CONCAT', -1, concat, deterministic=True)
+    paths = paths or sorted(glob.glob(os.path.join(REPORT_QUERY_DIR, '*.sql')))
+    report = {}
+    for path in paths:
+        with open(path) as file:
+            query = file.read().strip().rstrip(';')
+        try:
+            plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}')]
+        except sqlite3.Error as e:
+            logger.warning(f'Could not explain {path}: {e}')
+            continue
+        # An automatic index is built from a full scan of the table every time the query runs
+        full_scans = [step for step in plan if 'AUTOMATIC' in step or
+                      (step.startswith('SCAN ') and ' INDEX ' not in step and 'subquery' not in step and 'CONSTANT ROW' not in step)]
+        report[path] = full_scans
+        for step in full_scans:
+            logger.warning(f'{path}: full scan in query plan - {step}')
+        if not full_scans:
+            logger.info(f'{path}: no full scans in query plan')
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate database.db and check the query plans of the report queries')
+    parser.add_argument('--target', type=int, default=LATEST_VERSION, help='schema version to migrate to')
+    args = parser.parse_args()
+
+    conn = connect('migrations')
+    try:
+        migrate(conn, args.target)
+        analyze(conn)
+        report = check_query_plans(conn)
+    finally:
+        conn.close()
+    sys.exit(1 if any(report.values()) else 0)
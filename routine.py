@@ -1,35 +1,93 @@
-import load_listing, spatial_join_school, spatial_join_crime
 from time import perf_counter
 from loguru import logger
+import argparse
+import importlib
+import subprocess
 import sys
 
+# Stages of the data update routine in order of execution, and the module running each of them.
+# A module is only imported when its stage runs, so pandas, pandera, geopandas and shapely are not
+# loaded before any work starts and a single-stage run does not pay for the other stages.
+STAGES = {
+    'listings': 'load_listing', # Update rental listings in database
+    'spatial': 'spatial_joins', # perform the spatial joins of the crime and schools stages at the same time
+    'crime': 'spatial_join_crime', # perform spatial join with crime data
+    'schools': 'spatial_join_school', # perform spatial join with walk zones and attendance areas of schools
+}
+# Stages of the daily run, 'spatial' covers 'crime' and 'schools'
+DEFAULT_STAGES = ['listings', 'spatial']
+
+
+def run_stage(stage):
+    """
+    Import the module of a stage and run its main function.
+    """
+    start = perf_counter()
+    module = importlib.import_module(STAGES[stage])
+    logger.debug(f'Imported {STAGES[stage]} in {perf_counter() - start:.2f} seconds')
+    module.main()
+
+
+def profile_imports(top=10):
+    """
+    Report the import time of each stage module and its heaviest dependencies.
+
+    Each module is imported in a fresh interpreter with `python -X importtime`, so the numbers are not
+    skewed by modules already imported by another stage.
+
+    :param top: Number of dependencies to list per stage.
+    :return: A dict of stage -> list of (package, cumulative seconds), the module itself first.
+    """
+    report = {}
+    for stage, module in STAGES.items():
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True)
+        timings = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            package = name.strip().split('.')[0]
+            # Indentation shows nesting; skip interpreter startup imports which are not under the module
+            if len(name) - len(name.lstrip()) <= 1 and package != module:
+                continue
+            # Keep the outermost (largest) cumulative time of each top-level package
+            timings[package] = max(timings.get(package, 0), int(cumulative) / 1e6)
+        total = timings.pop(module, 0.0)
+        heaviest = sorted(timings.items(), key=lambda item: item[1], reverse=True)[:top]
+        report[stage] = [(module, total)] + heaviest
+
+        logger.info(f'Import of {module} ({stage}) takes {total:.2f} seconds')
+        for package, seconds in heaviest:
+            logger.info(f'    {package:<20} {seconds:.2f} seconds')
+    return report
+
+
+def main(stages=None):
 
-def main(): 
-    
     # Configure logger to show only INFO and above levels in the console. Set to "DEBUG" to see the steps in between.
     logger.remove()  # Remove default handler
     logger.add(sys.stderr, level="INFO")
-    
-    #Save logging to a file    
-    logger.add("log/routine.log", level = 'DEBUG', retention="1 week", backtrace=True, diagnose=True, enqueue = True) 
-    
+
+    #Save logging to a file
+    logger.add("log/routine.log", level = 'DEBUG', retention="1 week", backtrace=True, diagnose=True, enqueue = True)
+
     start = perf_counter()
     logger.info('Start data update routine')
-    
-    # Update rental listings in database
-    load_listing.main()
-    
-    # perform spatial join with crime data
-    spatial_join_crime.main()
-    
-    # perform spatial join with walk zones and attendance areas of schools
-    spatial_join_school.main()
-    
+
+    for stage in stages or DEFAULT_STAGES:
+        run_stage(stage)
 
     perf = perf_counter() - start
     minutes, seconds = divmod(perf, 60)
     logger.info(f'Time spent in data update routine = {int(minutes)} minutes {int(seconds)} seconds')
-    
-if __name__ == '__main__':    
-    main()
-    
\ No newline at end of file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Daily data update routine')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=DEFAULT_STAGES, help='run only these stages, in the given order')
+    parser.add_argument('--profile-imports', action='store_true', help='report the import time of each stage and exit')
+    args = parser.parse_args()
+
+    if args.profile_imports:
+        profile_imports()
+    else:
+        main(args.stages)
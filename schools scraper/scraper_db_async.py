@@ -49,6 +49,11 @@ class School:
 
 MAX_CONCURRENT_REQUESTS = 10  # Adjust this number based on server tolerance
 
+# CBE endpoints, kept at module level so they can be pointed at a local mock server for benchmarking
+SCHOOL_DIRECTORY_URL = 'https://www.cbe.ab.ca/schools/school-directory/Pages/default.aspx'
+PROFILE_URL = "https://www.cbe.ab.ca/schools/school-directory/_layouts/15/cbe.service.spm/viewprofile.aspx"
+OVERLAYS_URL = 'https://www.cbe.ab.ca/schools/find-a-school/_layouts/15/SchoolProfileManager/SchoolProfileManager.asmx/GetSchoolOverlays'
+
 # Semaphore to limit concurrent requests
 semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
@@ -162,7 +167,7 @@ def extract_text(html, selector, index):
 
 
 async def detail_page_loop(client, headers, school_ids):
-    url = "https://www.cbe.ab.ca/schools/school-directory/_layouts/15/cbe.service.spm/viewprofile.aspx"
+    url = PROFILE_URL
 
     tasks = []
     for school_id in school_ids:
@@ -181,7 +186,7 @@ async def get_school_ids(client, headers):
     """
     Fetches the school IDs from the CBE school directory page.
     """
-    url = 'https://www.cbe.ab.ca/schools/school-directory/Pages/default.aspx'
+    url = SCHOOL_DIRECTORY_URL
     try:
         response = await make_request(client, 'get', url, headers=headers)
         html = HTMLParser(response.text)
@@ -200,7 +205,7 @@ async def get_school_ids(client, headers):
 
 async def get_polygon(client, headers,school_id):
     querystring = {"id": school_id}
-    url = 'https://www.cbe.ab.ca/schools/find-a-school/_layouts/15/SchoolProfileManager/SchoolProfileManager.asmx/GetSchoolOverlays'
+    url = OVERLAYS_URL
     resp = await make_request(client, 'post', url, headers=headers, json=querystring)
     data = json.loads(resp.text)
     
@@ -290,6 +295,7 @@ async def main():
         #pd.DataFrame(school_list).to_csv('school_list.csv')
                
         db = School_db()
+        db.clear_schools()
         for school in school_list:
             db.insert_school(school)
         logger.debug('Finished updating database.')
@@ -0,0 +1,120 @@
+"""
+Archive of the listings DataFrames of each run, as compressed Parquet files partitioned by date.
+
+Each run of load_listing writes the listings it fetched ('raw') and, once they are loaded, every listing
+active in the database ('active') to `snapshots/<kind>/date=<YYYY-MM-DD>/<HHMMSS>.parquet`. With the
+fingerprint cache, 'raw' only holds the listings of the communities or tiles which changed since the previous
+run, so the market state of a day is read from the 'active' snapshots.
+
+Snapshots are read back as one DataFrame with `read_snapshots`, which only opens the partitions in the
+requested date range, only decodes the requested columns and memory-maps the files.
+"""
+import os
+from datetime import datetime
+from time import perf_counter
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.parquet as pq
+from loguru import logger
+from listing_dtypes import STRING_DTYPE
+
+SNAPSHOT_DIR = 'snapshots'
+SNAPSHOT_COMPRESSION = 'zstd'
+SNAPSHOT_COMPRESSION_LEVEL = 3
+ACTIVE_LISTINGS_QUERY = 'SELECT * FROM rental_listings WHERE is_active = 1'
+# Partition key of the directories, kept as text so that ISO dates compare in order
+PARTITIONING = ds.partitioning(pa.schema([('date', pa.string())]), flavor='hive')
+
+
+def to_arrow(df):
+    """
+    Convert a listings DataFrame to an Arrow table. Object columns of the raw listings mix numbers and
+    text (e.g. 'sq_feet'), they are stored as text.
+
+    :param df: A listings DataFrame at any stage of the pipeline.
+    :return: A pyarrow.Table without the index.
+    """
+    mixed = [column for column in df.columns if df[column].dtype == object]
+    if mixed:
+        df = df.astype({column: STRING_DTYPE for column in mixed})
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def write_snapshot(df, kind, when=None, root=SNAPSHOT_DIR):
+    """
+    Write a listings DataFrame to the archive. The file is written to a hidden file and renamed,
+    so a crashed run does not leave a partial file in a partition.
+
+    :param df: The DataFrame to archive.
+    :param kind: Name of the snapshot, e.g. 'raw' or 'active'.
+    :param when: Time of the run, now by default.
+    :param root: Directory of the archive.
+    :return: The path of the written file.
+    """
+    start = perf_counter()
+    when = when or datetime.now()
+    directory = os.path.join(root, kind, f'date={when:%Y-%m-%d}')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{when:%H%M%S}.parquet')
+    tmp_path = os.path.join(directory, f'.{when:%H%M%S}.parquet.tmp') # files starting with '.' are not read
+    pq.write_table(to_arrow(df), tmp_path, compression=SNAPSHOT_COMPRESSION, compression_level=SNAPSHOT_COMPRESSION_LEVEL)
+    os.replace(tmp_path, path)
+    logger.debug(f'Archived {len(df)} {kind} listings to {path} ({os.path.getsize(path) / 2**10:.1f} KB) in {perf_counter() - start:.3f} seconds')
+    return path
+
+
+def write_active_snapshot(conn, when=None, root=SNAPSHOT_DIR):
+    """
+    Archive every active listing of the database as the 'active' snapshot, whichever listings the run fetched.
+
+    :param conn: A connection to the database, after the listings of the run were committed.
+    :param when: Time of the run, now by default.
+    :param root: Directory of the archive.
+    :return: The path of the written file.
+    """
+    df = pd.read_sql_query(ACTIVE_LISTINGS_QUERY, conn)
+    return write_snapshot(df, 'active', when, root)
+
+
+def read_snapshots(kind, start=None, end=None, columns=None, root=SNAPSHOT_DIR, memory_map=True, last_run_only=False):
+    """
+    Read the archived snapshots of a kind into one DataFrame, with a 'date' column holding the date of the run
+    unless `columns` leaves it out.
+
+    The schemas of the files are unified, so a column which changed type between runs (e.g. int and
+    float prices) is read as the wider type.
+
+    :param kind: Name of the snapshot, e.g. 'raw' or 'active'.
+    :param start: First date to read as 'YYYY-MM-DD', inclusive. All dates by default.
+    :param end: Last date to read as 'YYYY-MM-DD', inclusive. All dates by default.
+    :param columns: Columns to read, all by default. Only these are decoded.
+    :param root: Directory of the archive.
+    :param memory_map: Whether the files are memory-mapped instead of read.
+    :param last_run_only: Whether only the last run of each date is read, e.g. one 'active' snapshot per day.
+    :return: A DataFrame, empty if no snapshot matches.
+    """
+    directory = os.path.join(root, kind)
+    if not os.path.isdir(directory):
+        return pd.DataFrame(columns=columns)
+    filesystem = pyarrow.fs.LocalFileSystem(use_mmap=memory_map)
+    date = ds.field('date')
+    condition = None
+    if start is not None:
+        condition = date >= start
+    if end is not None:
+        condition = date <= end if condition is None else condition & (date <= end)
+    # Partitions out of the date range are skipped from their directory name, without opening the files
+    dataset = ds.dataset(directory, format='parquet', partitioning=PARTITIONING, filesystem=filesystem)
+    paths = [fragment.path for fragment in dataset.get_fragments(filter=condition)]
+    if last_run_only:
+        # Files are named after the time of the run, so the last name of a partition is its last run
+        paths = list({os.path.dirname(path): path for path in sorted(paths)}.values())
+    if not paths:
+        return pd.DataFrame(columns=columns)
+    schema = pa.unify_schemas([pq.read_schema(path, memory_map=memory_map) for path in paths] + [PARTITIONING.schema],
+                              promote_options='permissive')
+    dataset = ds.dataset(paths, format='parquet', partitioning=PARTITIONING, partition_base_dir=directory,
+                         filesystem=filesystem, schema=schema)
+    return dataset.to_table(columns=columns).to_pandas()
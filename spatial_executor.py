@@ -0,0 +1,157 @@
+"""
+Parallel executor of the point-in-zone joins of the spatial join stages.
+
+The listing points of each join are cut into chunks which are mapped by a pool of worker processes. The
+geometries of the zones are written once as WKB into a shared memory block. Each task only carries the
+name of the block and the offsets of the geometries, and a worker builds its own ZoneIndex from the block
+the first time it sees a set of zones. The chunks of all the joins are submitted together, so the crime
+communities, attendance areas and walk zones are mapped at the same time.
+
+Small batches, such as the new listings of a daily run, are mapped in the calling process, where starting
+the workers would take longer than the joins.
+"""
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter
+import numpy as np
+import pandas as pd
+import shapely
+from loguru import logger
+from zone_index import ZoneIndex
+
+CHUNK_SIZE = 50_000 # points per task
+MIN_PARALLEL_POINTS = 100_000 # below this many points in total, the joins run in the calling process
+START_METHOD = 'spawn' # workers do not inherit the threads of the log handlers or the database connections
+
+
+@dataclass
+class SpatialJob:
+    """
+    Points to map with a set of zones.
+    """
+    name: str
+    index: ZoneIndex
+    df: pd.DataFrame # 'id', 'latitude' and 'longitude' of the listings
+    zone_column: str = 'zone_id' # name of the column of the zone ids in the result
+
+
+@dataclass(frozen=True)
+class SharedZones:
+    """
+    Where the WKB of a set of zones is in shared memory. This is what a task carries instead of the geometries.
+    """
+    name: str
+    block: str # name of the SharedMemory block
+    offsets: np.ndarray # geometry i is WKB bytes offsets[i]:offsets[i + 1]
+    zone_ids: np.ndarray
+
+
+def share_zones(index):
+    """
+    Write the geometries of an index as WKB into a new shared memory block.
+
+    :param index: A ZoneIndex.
+    :return: The SharedMemory block, to close and unlink once the joins are done, and its SharedZones.
+    """
+    wkb = shapely.to_wkb(index.geometries)
+    offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+    np.cumsum([len(geometry) for geometry in wkb], out=offsets[1:])
+    block = SharedMemory(create=True, size=max(int(offsets[-1]), 1))
+    block.buf[:offsets[-1]] = b''.join(wkb)
+    return block, SharedZones(index.name, block.name, offsets, index.zone_ids)
+
+
+# Indexes built by a worker process, by name of their shared memory block
+_WORKER_INDEXES = {}
+
+
+def _init_worker():
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+
+def _worker_index(zones):
+    index = _WORKER_INDEXES.get(zones.block)
+    if index is None:
+        block = SharedMemory(name=zones.block)
+        try:
+            buffer = block.buf
+            wkb = [bytes(buffer[start:end]) for start, end in zip(zones.offsets[:-1], zones.offsets[1:])]
+            del buffer # the block cannot be closed while a view of it exists
+        finally:
+            block.close()
+        index = _WORKER_INDEXES[zones.block] = ZoneIndex(shapely.from_wkb(wkb), zones.zone_ids, zones.name)
+    return index
+
+
+def _join_chunk(zones, ids, longitudes, latitudes):
+    """
+    Task of a worker: map a chunk of points to the zones containing them.
+
+    :return: The id of the point and the id of the zone of each (point, zone) pair.
+    """
+    point_positions, zone_ids = _worker_index(zones).query(longitudes, latitudes)
+    return ids[point_positions], zone_ids
+
+
+def default_workers():
+    """
+    Number of worker processes, one per core available to this process.
+    """
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+
+def run_joins(jobs, workers=None, chunk_size=CHUNK_SIZE, min_parallel_points=MIN_PARALLEL_POINTS):
+    """
+    Map the points of several jobs to their zones, in parallel when there are enough points.
+
+    :param jobs: List of SpatialJob.
+    :param workers: Number of worker processes, one per core by default. 1 runs the joins in the calling process.
+    :param chunk_size: Points per task.
+    :param min_parallel_points: Below this many points in total, the joins run in the calling process.
+    :return: A dict of job name -> DataFrame with 'id' and the zone column of the job, one row per (listing, zone) pair.
+    """
+    start = perf_counter()
+    workers = workers or default_workers()
+    points = sum(len(job.df) for job in jobs)
+    if workers <= 1 or points < min_parallel_points:
+        results = {job.name: job.index.join(job.df, zone_column=job.zone_column) for job in jobs}
+        workers = 1
+    else:
+        results = _run_parallel(jobs, workers, chunk_size)
+    seconds = perf_counter() - start
+    pairs = sum(len(result) for result in results.values())
+    logger.info(f'Mapped {points} points to {pairs} zone pairs in {len(jobs)} joins with {workers} '
+                f'{"processes" if workers > 1 else "process"} in {seconds:.2f} seconds ({points / seconds if seconds else 0:,.0f} points/s)')
+    return results
+
+
+def _run_parallel(jobs, workers, chunk_size):
+    blocks = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context(START_METHOD), initializer=_init_worker) as pool:
+            futures = {}
+            for job in jobs:
+                block, zones = share_zones(job.index)
+                blocks.append(block)
+                ids = job.df['id'].to_numpy()
+                longitudes = job.df['longitude'].to_numpy(dtype=float)
+                latitudes = job.df['latitude'].to_numpy(dtype=float)
+                futures[job.name] = [pool.submit(_join_chunk, zones, ids[i:i + chunk_size], longitudes[i:i + chunk_size], latitudes[i:i + chunk_size])
+                                     for i in range(0, len(job.df), chunk_size)]
+            results = {}
+            for job in jobs:
+                chunks = [future.result() for future in futures[job.name]]
+                results[job.name] = pd.DataFrame({
+                    'id': np.concatenate([ids for ids, _ in chunks]) if chunks else np.array([], dtype=np.int64),
+                    job.zone_column: np.concatenate([zone_ids for _, zone_ids in chunks]) if chunks else job.index.zone_ids[:0],
+                })
+            return results
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
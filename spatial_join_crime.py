@@ -1,25 +1,35 @@
-import pandas as pd
+import os
 import geopandas as gpd
-import sqlite3
 from loguru import logger
 from time import perf_counter
+from listing_dtypes import log_memory_usage
+from db import connect
+from migrations import migrate, analyze
+from zone_index import ZoneIndex, get_index
+from mapping_state import pending_listings, mark_processed
+from spatial_executor import SpatialJob, run_joins
 
+COMMUNITY_CRIME_PATH = 'community_boundaries/community_crime.geojson'
 
 
-def load(conn, cursor, df):
+
+def load(conn, cursor, df, listing_ids):
     """
-    Loads transformed data into the listing_with_crime table in the database.
+    Loads transformed data into the listing_with_crime table in the database,
+    and marks the processed listings as done for the crime stage.
     
     :param conn: A SQLite database connection.
     :param cursor: A SQLite cursor object.
     :param df: DataFrame with listing and crime IDs.
+    :param listing_ids: Ids of all the listings processed, including those outside every community.
     """
     
     try:
         logger.debug(f'Loading transformed data into the database...')
         insert_statement = 'INSERT INTO listing_with_crime (listing_id, crime_id) VALUES (?, ?)'
-        records_to_insert = [(row.id, row.row_id) for row in df.itertuples(index=False)]
+        records_to_insert = zip(df['id'].tolist(), df['row_id'].tolist())
         cursor.executemany(insert_statement, records_to_insert)
+        mark_processed(conn, 'crime', listing_ids, df['id'])
         conn.commit()
         logger.info(f'Successfully loaded mapping of community crime into the database.')
     
@@ -28,42 +38,74 @@ def load(conn, cursor, df):
         conn.rollback()  # Rollback any changes if an error occurs
         raise
 
+
+def community_index(path=COMMUNITY_CRIME_PATH):
+    """
+    Spatial index of the community boundaries with crime data, read again only when the file changes.
+    
+    :param path: Path of the GeoJSON file of community boundaries and crime.
+    :return: A ZoneIndex with the row_id of each community.
+    """
+    stat = os.stat(path)
+    def build():
+        community_crime = gpd.read_file(path)
+        logger.debug('Loaded geographic data of community and crime.')
+        return ZoneIndex.from_geodataframe(community_crime, 'row_id', 'communities')
+    return get_index('communities', (path, stat.st_mtime_ns, stat.st_size), build)
+
+
+
+def crime_job(conn):
+    """
+    Prepare the spatial join of the listings waiting for the crime stage with the community boundaries.
+    
+    :param conn: A SQLite database connection.
+    :return: A SpatialJob, to run with spatial_executor.run_joins.
+    """
+    # Load rental listings which are waiting to be mapped with community and crime data
+    df_listings = pending_listings(conn, 'crime')
+    total = df_listings.shape[0]
+    logger.debug(f'Found {total} rental listings which are not yet mapped with community and crime data.')
+    log_memory_usage(df_listings, 'Listings to map with crime')
+    return SpatialJob('crime', community_index(), df_listings, zone_column='row_id')
+
+
+def save_crime(conn, job, df_listings_crime_merged):
+    """
+    Load the mappings of a crime job into the database.
+    
+    :param conn: A SQLite database connection.
+    :param job: The SpatialJob returned by crime_job.
+    :param df_listings_crime_merged: Result of the job, with the 'id' and 'row_id' of each mapping.
+    """
+    total = job.df.shape[0]
+    mapped = df_listings_crime_merged.shape[0]
+    log_memory_usage(df_listings_crime_merged, 'Listings mapped with crime')
+    logger.info(f'Mapped {mapped} ({(mapped/total*100 if total else 0):.2f}%) rental listings.')
+
+    # Update database
+    cur = conn.cursor()
+    try:
+        load(conn, cur, df_listings_crime_merged, job.df['id'])
+    finally:
+        cur.close()
+
        
 def main():
     """
     Main execution function:
-    1. Reads unprocessed rental listings from the database.
+    1. Reads the rental listings waiting for the crime stage from the database.
     2. Performs a spatial join with community crime data.
     3. Loads the result back into the database.
     """
     start = perf_counter()
+    conn = None
     try:
-        conn = sqlite3.connect('database.db')
-        # Load rental listings which are not yet mapped with community and crime data
-        df_listings = pd.read_sql_query('''
-                                        SELECT id,latitude,longitude
-                                        FROM rental_listings
-                                        WHERE id NOT IN (
-                                        SELECT DISTINCT(listing_id) 
-                                        FROM listing_with_crime
-                                        )
-                                        ''', conn)
-        total = df_listings.shape[0]
-        gdf_listings = gpd.GeoDataFrame(df_listings, geometry=gpd.points_from_xy(df_listings['longitude'], df_listings['latitude']), crs="EPSG:4326")
-        logger.debug(f'Found {total} rental listings which are not yet mapped with community and crime data.')
-        
-        # Load geographic data of community and crime
-        community_crime = gpd.read_file("community_boundaries/community_crime.geojson")
-        logger.debug('Loaded geographic data of community and crime.')
-
-        # Spatial join
-        gdf_listings_crime_merged = gpd.sjoin(gdf_listings, community_crime, how="inner", lsuffix='rl', rsuffix='cc')
-        mapped = gdf_listings_crime_merged.shape[0]
-        logger.info(f'Mapped {mapped} ({(mapped/total*100):.2f}%) rental listings.')
-
-        # Update database
-        cur = conn.cursor()
-        load(conn, cur, gdf_listings_crime_merged)
+        conn = connect('crime')
+        migrate(conn)
+        job = crime_job(conn)
+        save_crime(conn, job, run_joins([job])[job.name])
+        analyze(conn)
         
     except Exception as e:
         logger.exception(f'An error occurred in the main function: {e}')
@@ -71,9 +113,7 @@ def main():
             conn.rollback()
             
     finally:
-        # Close cursor and connection
-        if cur:
-            cur.close()
+        # Close connection
         if conn:
             conn.close()
         logger.debug('Database connection and cursor closed.')
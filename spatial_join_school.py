@@ -1,9 +1,22 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-import sqlite3
+import shapely
+import pyarrow as pa
+import pyarrow.parquet as pq
 from shapely.geometry import Polygon, MultiPolygon
 from loguru import logger
 from time import perf_counter
+import hashlib
+import inspect
+import os
+from datetime import datetime
+from listing_dtypes import log_memory_usage
+from zone_index import ZoneIndex, get_index
+from mapping_state import MAPPING_STAGES, TIMESTAMP_FORMAT, pending_listings, mark_processed, recount_matches
+from spatial_executor import SpatialJob, run_joins
+from db import connect
+from migrations import migrate, analyze
 
 
 def transform_to_geometry(df):
@@ -49,21 +62,232 @@ def transform_to_geometry(df):
     return gdf
 
 
-def load(conn, cursor, df, table_name):
+# Compiled zone geometries are cached per zone type as WKB, with a fingerprint of the rows they were built from
+ZONE_CACHE_PATH = 'cache/zone_geometries_{zone_type}.parquet'
+ZONE_CACHE_VERSION = 1 # increase to rebuild the caches, the source of transform_to_geometry is also part of the fingerprint
+
+
+def zone_fingerprint(conn, zone_type):
+    """
+    Fingerprint of the rows a zone type is built from, computed by SQLite without reading the rows into Python.
+    
+    The sums are weighted by rowid, so any inserted, deleted, moved or reordered coordinate changes them.
+    Re-scraping the schools changes them too, as the zone tables use AUTOINCREMENT ids.
+    
+    :param conn: A SQLite database connection.
+    :param zone_type: Type of zone ('attendance_area' or 'walk_zone').
+    :return: A hex digest.
+    """
+    zones = conn.execute(f'''SELECT COUNT(*), MAX(rowid), TOTAL(rowid * school_id), TOTAL(rowid * polygon_number),
+                                     TOTAL(rowid * long_coordinate), TOTAL(rowid * lat_coordinate)
+                              FROM {zone_type}s''').fetchone()
+    schools = conn.execute('''SELECT COUNT(*), GROUP_CONCAT(school_id || ':' || name, '|')
+                              FROM schools''').fetchone()
+    digest = hashlib.sha256(f'{ZONE_CACHE_VERSION} {zones} {schools}'.encode('utf-8'))
+    digest.update(inspect.getsource(transform_to_geometry).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_zone_cache(path, fingerprint):
+    """
+    Read cached zone geometries if they were built from rows with the same fingerprint.
+    
+    :param path: Path of the cache file.
+    :param fingerprint: Fingerprint of the current rows, see zone_fingerprint.
+    :return: A GeoDataFrame with 'school_id', 'name' and 'geometry', or None if the cache is missing or stale.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        table = pq.read_table(path)
+    except (OSError, pa.ArrowException) as e:
+        logger.warning(f'Ignoring unreadable zone cache {path}: {e}')
+        return None
+    if (table.schema.metadata or {}).get(b'fingerprint', b'').decode('utf-8') != fingerprint:
+        return None
+    df = table.drop_columns(['geometry']).to_pandas()
+    return gpd.GeoDataFrame(df, geometry=shapely.from_wkb(table.column('geometry').to_numpy(zero_copy_only=False)), crs="EPSG:4326")
+
+
+def write_zone_cache(path, gdf, fingerprint):
+    """
+    Write compiled zone geometries as WKB, with their fingerprint in the file metadata.
+    The file is written to a temporary file and renamed, so a crashed run does not leave a partial cache.
+    
+    :param path: Path of the cache file.
+    :param gdf: GeoDataFrame returned by transform_to_geometry.
+    :param fingerprint: Fingerprint of the rows `gdf` was built from.
+    """
+    table = pa.table({'school_id': gdf['school_id'].to_numpy(),
+                      'name': gdf['name'].astype(object).to_numpy(),
+                      'geometry': pa.array(shapely.to_wkb(gdf.geometry.values), type=pa.binary())})
+    table = table.replace_schema_metadata({'fingerprint': fingerprint})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_zones(conn, zone_type, fingerprint=None):
+    """
+    Load the geometries of a zone type, one (Multi)Polygon per school, from the cache when the zone and school
+    tables did not change since it was built, otherwise from the coordinate rows.
+    
+    :param conn: A SQLite database connection.
+    :param zone_type: Type of zone ('attendance_area' or 'walk_zone').
+    :param fingerprint: Fingerprint of the zone rows if already computed, see zone_fingerprint.
+    :return: A GeoDataFrame with 'school_id', 'name' and 'geometry'.
     """
-    Loads transformed data into the specified table in the database.
+    start = perf_counter()
+    path = ZONE_CACHE_PATH.format(zone_type=zone_type)
+    fingerprint = fingerprint or zone_fingerprint(conn, zone_type)
+    gdf = read_zone_cache(path, fingerprint)
+    if gdf is not None:
+        logger.debug(f'Loaded {len(gdf)} {zone_type} geometries from cache in {perf_counter() - start:.3f} seconds.')
+        return gdf
+    
+    df_z = pd.read_sql_query(f'''SELECT s.school_id, s.name, z.polygon_number, z.lat_coordinate, z.long_coordinate
+                                FROM {zone_type}s z
+                                INNER JOIN schools s on s.school_id = z.school_id
+                                ''', conn)
+    # Transform to geographic data
+    gdf = gpd.GeoDataFrame(transform_to_geometry(df_z),
+                           geometry='geometry', 
+                           crs="EPSG:4326")
+    write_zone_cache(path, gdf, fingerprint)
+    logger.debug(f'Built {len(gdf)} {zone_type} geometries from {len(df_z)} coordinates in {perf_counter() - start:.3f} seconds.')
+    return gdf
+
+
+def zone_index(conn, zone_type):
+    """
+    Spatial index of the zones of a zone type, shared by the stages of the run until the zone rows change.
+    
+    :param conn: A SQLite database connection.
+    :param zone_type: Type of zone ('attendance_area' or 'walk_zone').
+    :return: A ZoneIndex with the school_id of each zone.
+    """
+    fingerprint = zone_fingerprint(conn, zone_type)
+    return get_index(zone_type, fingerprint,
+                     lambda: ZoneIndex.from_geodataframe(load_zones(conn, zone_type, fingerprint), 'school_id', zone_type))
+
+
+ZONE_VERSION_COLUMNS = ['school_id', 'geometry_hash', 'min_longitude', 'min_latitude', 'max_longitude', 'max_latitude']
+
+
+def zone_versions(index):
+    """
+    Version of the zone of each school: a hash of its geometry and its bounding box.
+    
+    :param index: ZoneIndex of a zone type.
+    :return: A DataFrame with ZONE_VERSION_COLUMNS.
+    """
+    # Normalized, so the same zone has the same hash whatever the order of its polygons and rings
+    wkb = shapely.to_wkb(shapely.normalize(index.geometries))
+    bounds = shapely.bounds(index.geometries)
+    return pd.DataFrame({'school_id': index.zone_ids,
+                         'geometry_hash': [hashlib.sha256(geometry).hexdigest() for geometry in wkb],
+                         'min_longitude': bounds[:, 0], 'min_latitude': bounds[:, 1],
+                         'max_longitude': bounds[:, 2], 'max_latitude': bounds[:, 3]})
+
+
+def listings_within_boxes(conn, boxes):
+    """
+    Read the listings within any of the given bounding boxes, through the index on the listing coordinates.
+    
+    :param conn: A SQLite database connection.
+    :param boxes: Iterable of (min_longitude, min_latitude, max_longitude, max_latitude).
+    :return: A DataFrame with 'id', 'latitude' and 'longitude'.
+    """
+    rows = {}
+    for min_longitude, min_latitude, max_longitude, max_latitude in boxes:
+        for row in conn.execute('''SELECT id, latitude, longitude FROM rental_listings
+                                    WHERE longitude BETWEEN ? AND ? AND latitude BETWEEN ? AND ?''',
+                                (min_longitude, max_longitude, min_latitude, max_latitude)):
+            rows[row[0]] = row
+    return pd.DataFrame(list(rows.values()), columns=['id', 'latitude', 'longitude'])
+
+
+def remap_changed_zones(conn, zone_type):
+    """
+    Replace the mappings of the schools whose zone changed since the zones were last versioned, e.g. after
+    the schools were scraped again. Only the listings within the old or new bounding box of a changed zone
+    are mapped again, and only with the changed zones. Listings waiting for the stage are left to zone_job.
+    
+    The first time, the versions of the zones are only recorded, the existing mappings being those of the
+    current zones.
+    
+    :param conn: A SQLite database connection.
+    :param zone_type: Type of zone ('attendance_area' or 'walk_zone').
+    :return: The ids of the schools whose mappings were replaced.
+    """
+    start = perf_counter()
+    table_name = MAPPING_STAGES[zone_type]
+    index = zone_index(conn, zone_type)
+    current = zone_versions(index)
+    stored = pd.read_sql_query(f'''SELECT {', '.join(ZONE_VERSION_COLUMNS)} FROM zone_versions WHERE zone_type = ?''',
+                               conn, params=[zone_type])
+    versions = current.merge(stored, on='school_id', how='outer', suffixes=('', '_old'))
+    changed = versions[versions['geometry_hash'].ne(versions['geometry_hash_old'])]
+    if changed.empty:
+        logger.debug(f'No {zone_type} changed since the last version')
+        return []
+    
+    now = datetime.now().strftime(TIMESTAMP_FORMAT)
+    changed_ids = changed['school_id'].astype('int64').tolist()
+    try:
+        if not stored.empty:
+            # Listings within the old or the new bounding box of a changed zone, except those waiting for the stage
+            boxes = pd.concat([changed[ZONE_VERSION_COLUMNS[2:]],
+                               changed[[f'{column}_old' for column in ZONE_VERSION_COLUMNS[2:]]].set_axis(ZONE_VERSION_COLUMNS[2:], axis=1)]).dropna()
+            df_listings = listings_within_boxes(conn, boxes.itertuples(index=False))
+            pending = pd.read_sql_query("SELECT listing_id FROM listing_mapping_state WHERE stage = ? AND status = 'pending'",
+                                        conn, params=[zone_type])
+            df_listings = df_listings[~df_listings['id'].isin(pending['listing_id'])]
+            
+            # Map them with the new zones of the changed schools, removed schools have none
+            new_zones = np.isin(index.zone_ids, changed_ids)
+            df_mapped = ZoneIndex(index.geometries[new_zones], index.zone_ids[new_zones], f'changed {zone_type}').join(df_listings, zone_column='school_id')
+            
+            conn.executemany(f'DELETE FROM {table_name} WHERE school_id = ?', ((school_id,) for school_id in changed_ids))
+            conn.executemany(f'INSERT INTO {table_name} (listing_id, school_id) VALUES (?, ?)',
+                             zip(df_mapped['id'].tolist(), df_mapped['school_id'].tolist()))
+            recount_matches(conn, zone_type, df_listings['id'])
+            logger.info(f'Remapped {len(df_listings)} listings around {len(changed_ids)} changed {zone_type} zones: '
+                        f'{len(df_mapped)} mappings in {perf_counter() - start:.2f} seconds')
+        else:
+            logger.info(f'Recorded the versions of {len(current)} {zone_type} zones')
+        
+        conn.executemany('DELETE FROM zone_versions WHERE zone_type = ? AND school_id = ?', ((zone_type, school_id) for school_id in changed_ids))
+        conn.executemany(f'''INSERT INTO zone_versions (zone_type, {', '.join(ZONE_VERSION_COLUMNS)}, updated_at)
+                             VALUES (?, {', '.join('?' * len(ZONE_VERSION_COLUMNS))}, ?)''',
+                         ((zone_type, *row, now) for row in current[current['school_id'].isin(changed_ids)].itertuples(index=False)))
+        conn.commit()
+    except Exception as e:
+        logger.exception(f'Error occurred while remapping the changed {zone_type} zones - {e}. Rolling back changes.')
+        conn.rollback()
+        raise
+    return changed_ids
+
+
+def load(conn, cursor, df, zone_type, listing_ids):
+    """
+    Loads transformed data into the mapping table of a zone type in the database,
+    and marks the processed listings as done for the zone type.
     
     :param conn: A SQLite database connection.
     :param cursor: A SQLite cursor object.
     :param df: DataFrame with listing and school IDs.
-    :param table_name: Name of the database table to insert data into.
+    :param zone_type: Type of zone ('attendance_area' or 'walk_zone').
+    :param listing_ids: Ids of all the listings processed, including those outside every zone.
     """
+    table_name = MAPPING_STAGES[zone_type]
     
     try:
         logger.info(f'Loading transformed data into {table_name} of the database...')
         insert_statement = f'INSERT INTO {table_name} (listing_id, school_id) VALUES (?, ?)'
-        records_to_insert = [(row.id, row.school_id) for row in df.itertuples(index=False)]
+        records_to_insert = zip(df['id'].tolist(), df['school_id'].tolist())
         cursor.executemany(insert_statement, records_to_insert)
+        mark_processed(conn, zone_type, listing_ids, df['id'])
         conn.commit()
         logger.info(f'Successfully loaded data into {table_name} of the database.')
     
@@ -72,48 +296,63 @@ def load(conn, cursor, df, table_name):
         conn.rollback()  # Rollback any changes if an error occurs
         raise
 
-def process_zone(conn, zone_type):
+ZONE_TYPES = ['attendance_area', 'walk_zone']
+
+
+def zone_job(conn, zone_type):
     """
-    Process either attendance area or walk zone.
+    Prepare the spatial join of the listings waiting for a zone type with its zones.
     
     :param conn: A SQLite database connection.
-    :param zone_type: Type of zone to process ('attendance_area' or 'walk_zones').
+    :param zone_type: Type of zone to process ('attendance_area' or 'walk_zone').
+    :return: A SpatialJob, to run with spatial_executor.run_joins.
     """
-    table_name = f'schools_within_{zone_type}'
-
-    # Load rental listings that do not have mapping of schools
-    df_listings = pd.read_sql_query(f'''
-                                    SELECT id,latitude,longitude
-                                    FROM rental_listings
-                                    WHERE id NOT IN (
-                                    SELECT DISTINCT(listing_id) 
-                                    FROM {table_name})
-                                    ''', conn)
+    # Load rental listings which are waiting to be mapped with schools
+    df_listings = pending_listings(conn, zone_type)
     
     total = df_listings.shape[0]
-    gdf_listings = gpd.GeoDataFrame(df_listings, geometry=gpd.points_from_xy(df_listings['longitude'], df_listings['latitude']), crs="EPSG:4326")
     logger.debug(f'Found {total} rental listings which are not yet mapped with {zone_type}')
+    log_memory_usage(df_listings, f'Listings to map with {zone_type}')
     
-    # Load zones from database.        
-    df_z = pd.read_sql_query(f'''SELECT s.school_id, s.name, z.polygon_number, z.lat_coordinate, z.long_coordinate
-                                FROM {zone_type}s z
-                                INNER JOIN schools s on s.school_id = z.school_id
-                                ''', conn)
-    logger.debug(f'Loaded {zone_type}.')
+    # Load zones, from the geometry cache when the zone tables did not change
+    return SpatialJob(zone_type, zone_index(conn, zone_type), df_listings, zone_column='school_id')
 
-    # Transform to geographic data
-    gdf_z_t = gpd.GeoDataFrame(transform_to_geometry(df_z),
-                                geometry='geometry', 
-                                crs="EPSG:4326")
+
+def save_zone(conn, job, df_z_listings):
+    """
+    Load the mappings of a zone job into the database.
     
-    # Spatial join
-    gdf_z_listings = gpd.sjoin(gdf_listings,gdf_z_t, how="inner",lsuffix='l',rsuffix='r')
-    mapped = gdf_z_listings.shape[0]
+    :param conn: A SQLite database connection.
+    :param job: The SpatialJob returned by zone_job.
+    :param df_z_listings: Result of the job, with the 'id' and 'school_id' of each mapping.
+    """
+    zone_type = job.name
+    mapped = df_z_listings.shape[0]
+    log_memory_usage(df_z_listings, f'Listings mapped with {zone_type}')
     logger.info(f'Created {mapped} mappings between {zone_type} and rental listings.')
 
-
     cur = conn.cursor()
-    load(conn, cur, gdf_z_listings, table_name)
+    try:
+        load(conn, cur, df_z_listings, zone_type, job.df['id'])
+    finally:
+        cur.close()
+
+
+def process_zones(conn, zone_types=ZONE_TYPES):
+    """
+    Process attendance areas and walk zones: replace the mappings of the zones which changed, then map the
+    waiting listings, the joins of both zone types running at the same time.
+    
+    :param conn: A SQLite database connection.
+    :param zone_types: Types of zone to process.
+    """
+    for zone_type in zone_types:
+        remap_changed_zones(conn, zone_type)
+    jobs = [zone_job(conn, zone_type) for zone_type in zone_types]
+    results = run_joins(jobs)
+    for job in jobs:
+        save_zone(conn, job, results[job.name])
+
 
 def main():
     """
@@ -121,12 +360,12 @@ def main():
     """
     start = perf_counter()
     conn = None
-    cur = None
     
     try:
-        conn = sqlite3.connect('database.db')
-        for zone_type in ['attendance_area', 'walk_zone']:
-            process_zone(conn, zone_type)
+        conn = connect('schools')
+        migrate(conn)
+        process_zones(conn)
+        analyze(conn)
             
     except Exception as e:
         logger.exception(f'An error occurred in the main function: {e}')
@@ -134,9 +373,7 @@ def main():
             conn.rollback()
             
     finally:
-        # Close cursor and connection
-        if cur:
-            cur.close()
+        # Close connection
         if conn:
             conn.close()
         logger.debug('Database connection and cursor closed.')
@@ -0,0 +1,50 @@
+from time import perf_counter
+from loguru import logger
+from db import connect
+from migrations import migrate, analyze
+from spatial_executor import run_joins
+from spatial_join_crime import crime_job, save_crime
+from spatial_join_school import ZONE_TYPES, remap_changed_zones, zone_job, save_zone
+
+
+def main():
+    """
+    Main execution function of the spatial joins stage: maps the listings waiting for the crime, attendance
+    area and walk zone stages at the same time, then loads the mappings of each stage into the database.
+    """
+    start = perf_counter()
+    conn = None
+
+    try:
+        conn = connect('spatial joins')
+        migrate(conn)
+        for zone_type in ZONE_TYPES:
+            remap_changed_zones(conn, zone_type)
+        crime = crime_job(conn)
+        zones = [zone_job(conn, zone_type) for zone_type in ZONE_TYPES]
+        results = run_joins([crime, *zones])
+        save_crime(conn, crime, results[crime.name])
+        for job in zones:
+            save_zone(conn, job, results[job.name])
+        analyze(conn)
+
+    except Exception as e:
+        logger.exception(f'An error occurred in the main function: {e}')
+        if conn:
+            conn.rollback()
+
+    finally:
+        # Close connection
+        if conn:
+            conn.close()
+        logger.debug('Database connection closed.')
+
+    # performance counter
+    perf = perf_counter() - start
+    minutes, seconds = divmod(perf, 60)
+    logger.debug(f'Time spent in mapping crime, attendance areas and walk zones = {int(minutes)} minutes {int(seconds)} seconds')
+
+
+if __name__ == '__main__':
+
+    main()
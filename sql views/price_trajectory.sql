@@ -0,0 +1,21 @@
+-- Price trajectory of the listings of a community, one row per logged change.
+-- The listing_changes rows of a listing are read from idx_listing_changes_listing_id alone.
+SELECT
+    rl.id,
+    rl."type",
+    lc.changed_at,
+    lc.change_type,
+    lc.price,
+    lc.price - LAG(lc.price) OVER (PARTITION BY lc.listing_id ORDER BY lc.changed_at) AS price_change,
+    lc.beds,
+    lc.sq_feet,
+    lc.is_active,
+    CONCAT('https://www.rentfaster.ca', rl.link) AS link
+FROM
+    rental_listings rl
+    INNER JOIN listing_changes lc ON lc.listing_id = rl.id
+WHERE
+    rl.community = 'Beltline'
+ORDER BY
+    rl.id,
+    lc.changed_at
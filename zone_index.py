@@ -0,0 +1,128 @@
+"""
+Reusable spatial index for point-in-zone lookups of the spatial join stages.
+
+A ZoneIndex holds an STRtree over prepared zone geometries (school attendance areas, walk zones or
+community boundaries) and maps batches of listing coordinates to the zones containing them with
+vectorized shapely predicates, without building GeoDataFrames of the points.
+
+Indexes are kept by `get_index` for the rest of the process, keyed by the name and fingerprint of the
+zones, so stages running in the same routine share them and only build an index again when its zones change.
+"""
+from collections import OrderedDict
+from time import perf_counter
+import numpy as np
+import pandas as pd
+import shapely
+from loguru import logger
+
+MAX_CACHED_INDEXES = 8
+
+
+class ZoneIndex:
+    """
+    STRtree over prepared zone geometries, each with the id of its zone.
+    """
+    def __init__(self, geometries, zone_ids, name='zones'):
+        """
+        :param geometries: Array-like of shapely (Multi)Polygons.
+        :param zone_ids: Id of each zone, e.g. the school_id or the crime row_id.
+        :param name: Name of the zones, used in logs.
+        """
+        start = perf_counter()
+        self.name = name
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.zone_ids = np.asarray(zone_ids)
+        if len(self.geometries) != len(self.zone_ids):
+            raise ValueError(f'{name}: {len(self.geometries)} geometries for {len(self.zone_ids)} ids')
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+        logger.debug(f'Built index of {len(self)} {name} in {perf_counter() - start:.3f} seconds.')
+
+    @classmethod
+    def from_geodataframe(cls, gdf, id_column, name='zones'):
+        """
+        Build an index from a GeoDataFrame in EPSG:4326.
+
+        :param gdf: GeoDataFrame of the zones.
+        :param id_column: Column holding the id of each zone.
+        :param name: Name of the zones, used in logs.
+        :return: A ZoneIndex.
+        """
+        if gdf.crs is not None and gdf.crs.to_epsg() != 4326:
+            gdf = gdf.to_crs(epsg=4326)
+        return cls(gdf.geometry.values, gdf[id_column].to_numpy(), name)
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def query(self, longitudes, latitudes):
+        """
+        Find the zones containing each point.
+
+        :param longitudes: Array-like of longitudes.
+        :param latitudes: Array-like of latitudes.
+        :return: Two arrays of the same length, the position of the point and the id of a zone containing it,
+                 ordered by point. A point in several zones appears once per zone, a point in none is left out.
+        """
+        longitudes = np.asarray(longitudes, dtype=float)
+        latitudes = np.asarray(latitudes, dtype=float)
+        # The tree only compares bounding boxes, the candidates are then tested in one vectorized call on the
+        # prepared zones, which is several times faster than a predicate query of the tree. As with gpd.sjoin,
+        # a point on the boundary of a zone is within it (intersects, not contains).
+        point_positions, zone_positions = self.tree.query(shapely.points(longitudes, latitudes))
+        within = shapely.intersects_xy(self.geometries[zone_positions], longitudes[point_positions], latitudes[point_positions])
+        point_positions, zone_positions = point_positions[within], zone_positions[within]
+        order = np.argsort(point_positions, kind='stable')
+        return point_positions[order], self.zone_ids[zone_positions[order]]
+
+    def join(self, df, id_column='id', zone_column='zone_id', longitude='longitude', latitude='latitude'):
+        """
+        Map the rows of a DataFrame of coordinates to the zones containing them.
+
+        :param df: DataFrame with an id and the coordinates of each row, e.g. rental listings.
+        :param id_column: Column of `df` identifying the rows.
+        :param zone_column: Name of the column holding the zone ids in the result.
+        :param longitude: Column of `df` holding the longitudes.
+        :param latitude: Column of `df` holding the latitudes.
+        :return: A DataFrame with `id_column` and `zone_column`, one row per (row, zone) pair.
+        """
+        start = perf_counter()
+        point_positions, zone_ids = self.query(df[longitude].to_numpy(), df[latitude].to_numpy())
+        mapped = pd.DataFrame({id_column: df[id_column].to_numpy()[point_positions], zone_column: zone_ids})
+        logger.debug(f'Mapped {len(df)} points to {len(mapped)} {self.name} pairs in {perf_counter() - start:.3f} seconds.')
+        return mapped
+
+
+_INDEXES = OrderedDict()
+
+
+def get_index(name, fingerprint, build):
+    """
+    Return the index of a set of zones, built by `build` the first time it is asked for in the process
+    or after the fingerprint of the zones changed.
+
+    :param name: Name of the zones, e.g. 'attendance_area'.
+    :param fingerprint: Any hashable value which changes with the zones.
+    :param build: Function without arguments returning a ZoneIndex.
+    :return: A ZoneIndex.
+    """
+    key = (name, fingerprint)
+    index = _INDEXES.get(key)
+    if index is None:
+        # An index of the same zones built from older rows is not needed anymore
+        for stale in [cached for cached in _INDEXES if cached[0] == name]:
+            del _INDEXES[stale]
+        index = _INDEXES[key] = build()
+        while len(_INDEXES) > MAX_CACHED_INDEXES:
+            _INDEXES.popitem(last=False)
+    else:
+        _INDEXES.move_to_end(key)
+        logger.debug(f'Reusing index of {len(index)} {name}.')
+    return index
+
+
+def clear_indexes():
+    """
+    Drop the indexes kept by get_index.
+    """
+    _INDEXES.clear()